@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Auto-buy: fire a prepared order request as soon as a server is detected
+
+Try a configuration against a local stand-in order API, in dry-run mode:
+
+    python autobuy.py standin --port 8765
+    python autobuy.py fire KS-3A
+"""
+
+import os
+import json
+import time
+import socket
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from metrics import REGISTRY
+from subscriptions import subscription_states
+# Python 3 imports
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+
+_logger = logging.getLogger(__name__)
+
+
+class Ledger(object):
+    """Orders placed, saved to a JSON file so that guards hold across
+    restarts. Without filename, orders are only kept in memory"""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.orders = []    # (ts, server, price)
+        if filename and os.path.isfile(filename):
+            with open(filename) as ledger_file:
+                self.orders = [tuple(order) for order in json.load(ledger_file)]
+
+    def record(self, server, price):
+        self.orders.append((time.time(), server, price))
+
+    def since(self, ts, server=None):
+        return [order for order in self.orders if order[0] >= ts and
+                (server is None or order[1] == server)]
+
+    def save(self):
+        if not self.filename:
+            return
+        tmp_path = self.filename + '.tmp'
+        with open(tmp_path, 'w') as ledger_file:
+            json.dump(list(self.orders), ledger_file)
+        os.rename(tmp_path, self.filename)
+
+
+class OrderRule(object):
+    """Order request of one server, fired when any of its states becomes
+    available, within its guards"""
+
+    def __init__(self, server, states, url, method='POST', headers=None,
+                 body=None, price=0, max_orders=1, max_spend=None,
+                 min_interval=3600):
+        self.server = server
+        self.states = states
+        self.url = url
+        self.method = method
+        self.headers = dict(headers or {})
+        # serialized once, nothing but the request is built when firing
+        if body is not None and not isinstance(body, (bytes, str)):
+            body = json.dumps(body)
+            self.headers.setdefault('Content-Type', 'application/json')
+        self.body = body
+        self.price = price
+        self.max_orders = max_orders
+        self.max_spend = max_spend
+        self.min_interval = min_interval
+
+    @classmethod
+    def from_config(cls, rule, config):
+        """Rules take 'server', places like subscriptions ('region',
+        'regions', 'datacenters', 'tier'), and request and guard settings"""
+        return cls(rule['server'],
+                   subscription_states(dict(rule, servers=[rule['server']])),
+                   rule.get('url', config.get('autobuy_url')),
+                   method=rule.get('method', 'POST'),
+                   headers=rule.get('headers', config.get('autobuy_headers')),
+                   body=rule.get('body'),
+                   price=rule.get('price', 0),
+                   max_orders=rule.get('max_orders', 1),
+                   max_spend=rule.get('max_spend'),
+                   min_interval=rule.get('min_interval', 3600))
+
+
+class AutoBuyer(object):
+    """Fire order requests on transitions, on a warm connection.
+
+    Host names of the order URLs are resolved in the background and, with
+    the curl client, pinned in requests; a request to every origin every
+    warm_interval seconds keeps its connection open, so that firing an
+    order costs no DNS lookup nor TLS handshake. Orders are recorded in
+    the ledger before being sent, and refused when a rule exceeds its
+    max_orders or max_spend over the last window seconds, or fires again
+    within min_interval, or when all rules exceed max_spend together.
+
+    In dry-run mode, the ledger is kept in memory, and requests go to
+    dry_run_url, e.g. a local stand-in API, or are only logged."""
+
+    def __init__(self, rules, ledger=None, dry_run=True, dry_run_url=None,
+                 window=86400, max_spend=None, warm_interval=30):
+        self.rules = rules
+        self.ledger = ledger or Ledger()
+        self.dry_run = dry_run
+        self.dry_run_url = dry_run_url
+        self.window = window
+        self.max_spend = max_spend
+        self.warm_interval = warm_interval
+        self.by_state = {}
+        for rule in rules:
+            if dry_run:
+                rule.url = dry_run_url
+            for state in rule.states:
+                self.by_state.setdefault(state, []).append(rule)
+        self.states = frozenset(self.by_state)
+        self.resolved = {}  # (host, port) -> address
+        self.periodic_cb = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.http_client = AsyncHTTPClient()
+        self.curl = type(self.http_client).__name__ == 'CurlAsyncHTTPClient'
+        self.latency = REGISTRY.histogram(
+            'autobuy_request_seconds', 'Order request round trip')
+        self.orders = dict(
+            (result, REGISTRY.counter('autobuy_orders_total',
+                                      'Order attempts', result=result))
+            for result in ('sent', 'failed', 'blocked'))
+
+    @classmethod
+    def from_config(cls, config):
+        dry_run = config.get('autobuy_dry_run', True)
+        if not dry_run and not config.get('autobuy_ledger'):
+            raise ValueError("autobuy_ledger is required unless "
+                             "autobuy_dry_run, to enforce guards on restart")
+        return cls([OrderRule.from_config(rule, config)
+                    for rule in config['autobuy']],
+                   ledger=None if dry_run else Ledger(config['autobuy_ledger']),
+                   dry_run=dry_run,
+                   dry_run_url=config.get('autobuy_dry_run_url'),
+                   window=config.get('autobuy_window', 86400),
+                   max_spend=config.get('autobuy_max_spend'),
+                   warm_interval=config.get('autobuy_warm_interval', 30))
+
+    def start(self):
+        """Warm connections now and periodically on the current IOLoop"""
+        if self.dry_run:
+            _logger.warning("Auto-buy in dry-run mode, orders go to %s",
+                            self.dry_run_url or 'the log only')
+        if not self.curl:
+            _logger.warning("Install pycurl for auto-buy to reuse warm "
+                            "connections and pinned DNS")
+        IOLoop.current().spawn_callback(self.warm)
+        self.periodic_cb = PeriodicCallback(self.warm,
+                                            self.warm_interval * 1000)
+        self.periodic_cb.start()
+
+    def origins(self):
+        origins = set()
+        for rule in self.rules:
+            if rule.url:
+                parts = urlsplit(rule.url)
+                origins.add((parts.scheme, parts.hostname, parts.port or
+                             (443 if parts.scheme == 'https' else 80)))
+        return origins
+
+    @coroutine
+    def warm(self):
+        for scheme, host, port in self.origins():
+            try:
+                infos = yield self.executor.submit(
+                    socket.getaddrinfo, host, port, 0, socket.SOCK_STREAM)
+                self.resolved[(host, port)] = infos[0][4][0]
+                yield self.http_client.fetch(
+                    '%s://%s:%s/' % (scheme, host, port), method='HEAD',
+                    request_timeout=10, raise_error=False)
+            except Exception as ex:
+                _logger.warning("Cannot warm connection to %s: %s", host, ex)
+
+    def trigger(self, changes):
+        """Fire the orders of rules watching any of the changed states"""
+        fired = set()
+        for state, _ in changes:
+            for rule in self.by_state.get(state, ()):
+                if rule not in fired:
+                    fired.add(rule)
+                    self.fire(rule, state)
+
+    def check(self, rule):
+        """Reason to refuse an order of rule, None if it is allowed"""
+        now = time.time()
+        orders = self.ledger.since(now - self.window, rule.server)
+        if len(orders) >= rule.max_orders:
+            return "%s orders in window" % len(orders)
+        if orders and now - orders[-1][0] < rule.min_interval:
+            return "last order %.0fs ago" % (now - orders[-1][0])
+        spent = sum(order[2] for order in orders)
+        if rule.max_spend is not None and spent + rule.price > rule.max_spend:
+            return "would spend %s of %s" % (spent + rule.price, rule.max_spend)
+        if self.max_spend is not None:
+            spent = sum(order[2] for order in self.ledger.since(
+                now - self.window))
+            if spent + rule.price > self.max_spend:
+                return "would spend %s of %s overall" % (
+                    spent + rule.price, self.max_spend)
+        return None
+
+    def fire(self, rule, state):
+        reason = self.check(rule)
+        if reason is not None:
+            self.orders['blocked'].inc()
+            _logger.warning("Auto-buy of %s blocked: %s", rule.server, reason)
+            return
+        self.ledger.record(rule.server, rule.price)
+        if not rule.url:
+            self.orders['sent'].inc()
+            _logger.warning("Auto-buy of %s on %s (dry run, not sent)",
+                            rule.server, state)
+            return
+        IOLoop.current().spawn_callback(self.send, rule, state)
+        self.executor.submit(self.ledger.save)
+
+    @coroutine
+    def send(self, rule, state):
+        parts = urlsplit(rule.url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        address = self.resolved.get((parts.hostname, port))
+        prepare = None
+        if self.curl and address:
+            import pycurl
+
+            def prepare(curl):
+                curl.setopt(pycurl.RESOLVE,
+                            ['%s:%s:%s' % (parts.hostname, port, address)])
+        started = time.time()
+        try:
+            resp = yield self.http_client.fetch(HTTPRequest(
+                rule.url, method=rule.method, headers=rule.headers,
+                body=rule.body, request_timeout=10,
+                prepare_curl_callback=prepare))
+        except Exception as ex:
+            self.orders['failed'].inc()
+            _logger.error("Auto-buy of %s on %s failed: %s",
+                          rule.server, state, ex)
+            return
+        self.latency.observe(time.time() - started)
+        self.orders['sent'].inc()
+        _logger.warning("Auto-buy of %s on %s sent in %.0fms%s: %s",
+                        rule.server, state, (time.time() - started) * 1000,
+                        ' (dry run)' if self.dry_run else '',
+                        resp.body[:200])
+
+    def close(self):
+        if self.periodic_cb is not None:
+            self.periodic_cb.stop()
+        self.executor.shutdown(wait=True)
+
+
+def main():
+    import tornado.web
+    from crawler import parse_json_file, CURRENT_PATH
+    parser = argparse.ArgumentParser(description="Try auto-buy rules")
+    commands = parser.add_subparsers(dest='command')
+    standin = commands.add_parser('standin', help="serve a stand-in order "
+                                  "API logging the orders it receives")
+    standin.add_argument('--port', type=int, default=8765)
+    fire = commands.add_parser('fire', help="fire the rules of a server in "
+                               "dry-run mode, to autobuy_dry_run_url")
+    fire.add_argument('server')
+    args = parser.parse_args()
+
+    if args.command == 'standin':
+        class OrderHandler(tornado.web.RequestHandler):
+            def post(self, path):
+                _logger.info("Order %s: %s", path, self.request.body[:200])
+                self.write({'orderId': int(time.time()), 'dryRun': True})
+            put = post
+
+            def head(self, path):
+                pass
+        tornado.web.Application([(r'/(.*)', OrderHandler)]).listen(
+            args.port, '127.0.0.1')
+        _logger.info("Stand-in order API on http://127.0.0.1:%s/", args.port)
+        IOLoop.current().start()
+    elif args.command == 'fire':
+        config = parse_json_file(os.path.join(CURRENT_PATH, 'config.json'))
+        config['autobuy_dry_run'] = True
+        config.setdefault('autobuy_dry_run_url', 'http://127.0.0.1:8765/order')
+        buyer = AutoBuyer.from_config(config)
+
+        @coroutine
+        def run():
+            yield buyer.warm()
+            for rule in buyer.rules:
+                if rule.server.lower() == args.server.lower():
+                    yield buyer.send(rule, 'manual')
+        IOLoop.current().run_sync(run)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
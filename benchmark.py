@@ -0,0 +1,605 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks for the crawler pipeline, run on recorded API payloads
+
+    python benchmark.py parse payload.json [payload.json ...]
+    python benchmark.py parse --synthetic 5000
+    python benchmark.py record recordings/ --count 50
+    python benchmark.py replay recordings/ --speed 10
+    python benchmark.py loop --endpoints 200 --interval 0.05
+    python benchmark.py flap --confirm-polls 2 --pattern 0101101110
+    python benchmark.py stream
+"""
+
+import io
+import os
+import asyncio
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tracemalloc
+import tornado.web
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPResponse
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from crawler import load_mappings, Crawler, Endpoint
+from hedging import MirrorSet
+from dispatcher import Dispatcher
+from notifiers.base_notifier import Notifier
+from state_index import StateIndex, StateTable, state_key
+from json_stream import ArrayStreamParser
+
+
+def synthetic_payload(entries, phase=0):
+    """Availability payload with the given number of hardware entries, a
+    few of them known to the mappings. Availabilities rotate with phase"""
+    server_types, regions = load_mappings()
+    known = sorted(server_types)
+    datacenters = sorted(set(dc for places in regions.values() for dc in places))
+    payload = []
+    for i in range(entries):
+        hardware = known[i] if i < len(known) else '%dunknown%d' % (i, i)
+        payload.append({
+            'hardware': hardware,
+            'region': 'europe',
+            'datacenters': [{'datacenter': dc,
+                             'availability': '72H' if (i + j + phase) % 3 else 'unavailable'}
+                            for j, dc in enumerate(datacenters)],
+        })
+    return json.dumps(payload).encode('utf-8')
+
+
+def chunked(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+def parse_buffered(chunks, table):
+    """Current path: buffer the body, decode and load it, then evaluate"""
+    body = b''.join(chunks)
+    for entry in json.loads(body.decode('utf-8')):
+        table.update(entry)
+
+
+def parse_streaming(chunks, table):
+    """Streaming path: evaluate entries as chunks are fed"""
+    parser = ArrayStreamParser(table.update)
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+
+
+def measure(func, chunks, table, repeat):
+    """Return best wall time and peak traced memory of func"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(chunks, table)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func(chunks, table)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def cmd_parse(args):
+    """Compare buffered and streaming parsing of the availability payload"""
+    server_types, regions = load_mappings()
+    # cells are kept between runs, as between polls of the crawler
+    table = StateTable(StateIndex(server_types, regions))
+    if args.synthetic:
+        payloads = [('synthetic-%d' % args.synthetic,
+                     synthetic_payload(args.synthetic))]
+    else:
+        payloads = []
+        for filename in args.payloads:
+            with open(filename, 'rb') as payload:
+                payloads.append((filename, payload.read()))
+    if not payloads:
+        sys.exit("No payload given, pass files or --synthetic N")
+    print("%-28s %10s %12s %12s %12s %12s" % (
+        'payload', 'size', 'buffered', 'streaming', 'buf peak', 'str peak'))
+    for name, body in payloads:
+        chunks = chunked(body, args.chunk_size)
+        buf_time, buf_peak = measure(parse_buffered, chunks, table, args.repeat)
+        str_time, str_peak = measure(parse_streaming, chunks, table, args.repeat)
+        print("%-28s %9dK %10.2fms %10.2fms %11dK %11dK" % (
+            os.path.basename(name)[:28], len(body) // 1024,
+            buf_time * 1000, str_time * 1000, buf_peak // 1024, str_peak // 1024))
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Nearest-rank percentiles of values"""
+    values = sorted(values)
+    if not values:
+        return dict((p, 0.0) for p in points)
+    return dict((p, values[min(len(values) - 1, int(len(values) * p / 100.0))])
+                for p in points)
+
+
+class Recorder(object):
+    """Stand-in for a metrics histogram keeping every observed value"""
+
+    def __init__(self):
+        self.values = []
+
+    def observe(self, value):
+        self.values.append(value)
+
+
+class MockNotifier(Notifier):
+    """Notifier recording when each notification was received"""
+
+    def check_requirements(self):
+        self.received = []
+
+    def notify(self, title, text, url=None):
+        self.received.append(time.perf_counter())
+
+
+class Recording(object):
+    """API responses saved to a directory, with their capture times"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'index.json')) as index:
+            self.index = json.load(index)
+        self.bodies = []
+        for item in self.index:
+            with open(os.path.join(directory, item['file']), 'rb') as body:
+                self.bodies.append(body.read())
+        self.position = 0
+
+    def next_body(self):
+        body = self.bodies[self.position % len(self.bodies)]
+        self.position += 1
+        return body
+
+    def mean_interval(self):
+        times = [item['ts'] for item in self.index]
+        if len(times) < 2:
+            return 0
+        return (times[-1] - times[0]) / (len(times) - 1)
+
+    @staticmethod
+    def save(directory, bodies_with_times):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        index = []
+        for i, (ts, body) in enumerate(bodies_with_times):
+            name = '%04d.json' % i
+            with open(os.path.join(directory, name), 'wb') as out:
+                out.write(body)
+            index.append({'file': name, 'ts': ts, 'size': len(body)})
+        with open(os.path.join(directory, 'index.json'), 'w') as out:
+            json.dump(index, out, indent=1)
+
+
+class ReplayHandler(tornado.web.RequestHandler):
+    """Local stand-in for the availability API, answering after delay
+    seconds, or stall seconds on a stall_rate share of requests"""
+
+    def initialize(self, recording, delay=0, stall=0, stall_rate=0):
+        self.recording = recording
+        self.delay = delay
+        self.stall = stall
+        self.stall_rate = stall_rate
+
+    @gen.coroutine
+    def get(self):
+        delay = self.delay
+        if self.stall_rate and random.random() < self.stall_rate:
+            delay = self.stall
+        if delay:
+            yield gen.sleep(delay)
+        self.set_header('Content-Type', 'application/json')
+        self.write(self.recording.next_body())
+
+
+class ReplayClient(object):
+    """AsyncHTTPClient stand-in answering from a recording, no network"""
+
+    def __init__(self, recording):
+        self.recording = recording
+
+    @gen.coroutine
+    def fetch(self, url, streaming_callback=None, **kwargs):
+        body = self.recording.next_body()
+        if streaming_callback is not None:
+            for i in range(0, len(body), 16384):
+                streaming_callback(body[i:i + 16384])
+            body = b''
+        raise gen.Return(HTTPResponse(HTTPRequest(url), 200,
+                                      buffer=io.BytesIO(body)))
+
+
+@gen.coroutine
+def record(url, directory, count, interval):
+    client = AsyncHTTPClient()
+    bodies = []
+    for i in range(count):
+        resp = yield client.fetch(url)
+        bodies.append((time.time(), resp.body))
+        print("recorded %d/%d, %d bytes" % (i + 1, count, len(resp.body)))
+        if i + 1 < count:
+            yield gen.sleep(interval)
+    Recording.save(directory, bodies)
+
+
+def cmd_record(args):
+    """Record availability API responses to a directory"""
+    if args.synthetic:
+        Recording.save(args.directory, [
+            (i * args.interval, synthetic_payload(args.synthetic, phase=i))
+            for i in range(args.count)])
+        return
+    IOLoop.current().run_sync(
+        lambda: record(args.url, args.directory, args.count, args.interval))
+
+
+@gen.coroutine
+def replay(args, recording):
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+    if args.no_server:
+        endpoint = Endpoint(url='replay://', streaming=args.streaming)
+    else:
+        urls = []
+        for delay in args.mirror_delays or [0]:
+            sockets = bind_sockets(0, '127.0.0.1')
+            server = HTTPServer(tornado.web.Application(
+                [(r'/', ReplayHandler, {'recording': recording,
+                                        'delay': delay, 'stall': args.stall,
+                                        'stall_rate': args.stall_rate})]))
+            server.add_sockets(sockets)
+            urls.append('http://127.0.0.1:%d/' % sockets[0].getsockname()[1])
+        mirrors = None
+        if len(urls) > 1:
+            mirrors = MirrorSet(urls, min_delay=args.hedge_min_delay)
+        endpoint = Endpoint(url=urls[0], streaming=args.streaming,
+                            timeout=max(30, args.stall * 2), mirrors=mirrors)
+    endpoint.parse_time = Recorder()
+    endpoint.fetch_time = Recorder()
+
+    notifier = MockNotifier({})
+    dispatcher = Dispatcher(notifier, workers=1)
+    dispatcher.start()
+    detected = []
+
+    def state_changed(changes):
+        detected.append(time.perf_counter())
+        dispatcher.submit([message for _, message in changes])
+
+    tracked = None
+    if args.servers:
+        tracked = set(state_key(server, region) for server in args.servers
+                      for region in args.regions)
+    crawler = Crawler(state_changed, endpoints=[endpoint],
+                      tracked_states=tracked)
+    if args.no_server:
+        crawler.http_client = ReplayClient(recording)
+    delay = recording.mean_interval() / args.speed if args.speed else 0
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    iteration_times = []
+    started = time.perf_counter()
+    for _ in range(args.iterations):
+        iteration_started = time.perf_counter()
+        yield crawler.run(endpoint)
+        iteration_times.append(time.perf_counter() - iteration_started)
+        if delay:
+            yield gen.sleep(delay)
+    elapsed = time.perf_counter() - started
+    yield dispatcher.flush()
+    if args.tracemalloc:
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    print("\n%d iterations in %.3fs: %.1f iterations/s" % (
+        args.iterations, elapsed, args.iterations / elapsed))
+    for name, values in (('iteration', iteration_times),
+                         ('fetch', endpoint.fetch_time.values),
+                         ('parse', endpoint.parse_time.values)):
+        pct = percentiles(values)
+        print("%-10s p50 %8.3fms  p90 %8.3fms  p99 %8.3fms  (%d samples)" % (
+            name, pct[50] * 1000, pct[90] * 1000, pct[99] * 1000, len(values)))
+    latencies = [received - detected_at for detected_at, received
+                 in zip(detected, notifier.received)]
+    pct = percentiles(latencies)
+    print("%-10s p50 %8.3fms  p90 %8.3fms  p99 %8.3fms  (%d notifications)" % (
+        'notify', pct[50] * 1000, pct[90] * 1000, pct[99] * 1000,
+        len(latencies)))
+    print("skipped iterations: %d not modified, %d unchanged" % (
+        endpoint.not_modified.value, endpoint.unchanged.value))
+    if endpoint.mirrors is not None:
+        print("hedged requests: %d, wins: %s" % (
+            endpoint.mirrors.hedged.value,
+            ', '.join('%s %d' % (mirror.host, mirror.wins.value)
+                      for mirror in endpoint.mirrors.mirrors)))
+    if args.tracemalloc:
+        print("\ntracemalloc peak: %dK, top allocations:" % (peak // 1024))
+        for stat in snapshot.statistics('lineno')[:10]:
+            print("  %s" % stat)
+
+
+class StaticClient(object):
+    """AsyncHTTPClient stand-in answering the same body at once"""
+
+    def __init__(self, body):
+        self.body = body
+
+    async def fetch(self, url, streaming_callback=None, **kwargs):
+        return HTTPResponse(HTTPRequest(url), 200,
+                            buffer=io.BytesIO(self.body))
+
+
+class LagCrawler(Crawler):
+    """Crawler recording how late each poll starts after it was due"""
+
+    def __init__(self, *args, **kwargs):
+        Crawler.__init__(self, *args, **kwargs)
+        self.due = {}
+        self.lags = []
+
+    async def poll(self, endpoint):
+        now = time.time()
+        if endpoint in self.due:
+            self.lags.append(now - self.due[endpoint])
+        self.due[endpoint] = now + endpoint.interval
+        await Crawler.poll(self, endpoint)
+
+
+async def poll_loop(args):
+    endpoints = [Endpoint(url='static://%d' % i, interval=args.interval)
+                 for i in range(args.endpoints)]
+    crawler = LagCrawler(lambda changes: None, endpoints=endpoints)
+    # payloads never change after the first, iterations measure the
+    # loop, scheduling and fetch overhead, not parsing
+    crawler.http_client = StaticClient(synthetic_payload(args.entries))
+    # counters are shared with the endpoints of previous runs
+    iterations = -sum(endpoint.iterations.value for endpoint in endpoints)
+    cpu = time.process_time()
+    crawler.start()
+    await asyncio.sleep(args.duration)
+    await crawler.stop()
+    cpu = time.process_time() - cpu
+    iterations += sum(endpoint.iterations.value for endpoint in endpoints)
+    return iterations, cpu, crawler.lags
+
+
+def cmd_loop(args):
+    """Poll many stand-in endpoints at a high rate, per event loop"""
+    logging.getLogger().setLevel(logging.WARNING)
+    for name in args.loops:
+        if name == 'uvloop':
+            try:
+                import uvloop
+            except ImportError:
+                print("uvloop is not installed, skipped")
+                continue
+            loop = uvloop.new_event_loop()
+        else:
+            loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        iterations, cpu, lags = loop.run_until_complete(poll_loop(args))
+        loop.close()
+        pct = percentiles(lags)
+        print("%-8s %d endpoints every %.3fs: %.0f iterations/s, "
+              "%.1fus CPU per iteration" % (
+                  name, args.endpoints, args.interval,
+                  iterations / args.duration, cpu / iterations * 1e6))
+        print("%-8s poll lag p50 %8.3fms  p90 %8.3fms  p99 %8.3fms" % (
+            '', pct[50] * 1000, pct[90] * 1000, pct[99] * 1000))
+
+
+class SequenceClient(object):
+    """AsyncHTTPClient stand-in answering the next of a list of bodies"""
+
+    def __init__(self, bodies):
+        self.bodies = list(bodies)
+
+    async def fetch(self, url, streaming_callback=None, **kwargs):
+        return HTTPResponse(HTTPRequest(url), 200,
+                            buffer=io.BytesIO(self.bodies.pop(0)))
+
+
+def flap_payload(hardware, available):
+    """Payload with one hardware, available in all datacenters or none"""
+    _, regions = load_mappings()
+    datacenters = sorted(set(dc for places in regions.values()
+                             for dc in places))
+    return json.dumps([{
+        'hardware': hardware,
+        'region': 'europe',
+        'datacenters': [{'datacenter': dc,
+                         'availability': '72H' if available else 'unavailable'}
+                        for dc in datacenters],
+    }]).encode('utf-8')
+
+
+def expected_alerts(pattern, confirm_polls):
+    """Polls alerting when availabilities follow pattern: those ending a
+    run of confirm_polls available polls"""
+    alerts, run = [], 0
+    for poll, available in enumerate(pattern):
+        run = run + 1 if available else 0
+        if run == max(1, confirm_polls):
+            alerts.append(poll)
+    return alerts
+
+
+def cmd_flap(args):
+    """Replay flapping availabilities, check alerts wait for confirm_polls"""
+    logging.getLogger().setLevel(logging.WARNING)
+    pattern = [char == '1' for char in args.pattern]
+    server_types, _ = load_mappings()
+    hardware = sorted(server_types)[0]
+    alerts = []
+    crawler = Crawler(lambda changes: alerts.append(poll),
+                      endpoints=[Endpoint(url='flap://')],
+                      confirm_polls=args.confirm_polls)
+    # repeated bodies take the unchanged path, they count as polls too
+    crawler.http_client = SequenceClient(
+        flap_payload(hardware, available) for available in pattern)
+    loop = asyncio.new_event_loop()
+    for poll in range(len(pattern)):
+        loop.run_until_complete(crawler.run(crawler.endpoints[0]))
+    loop.close()
+    expected = expected_alerts(pattern, args.confirm_polls)
+    print("pattern %s, confirm_polls %d: alerts on polls %s, expected %s" % (
+        args.pattern, args.confirm_polls, alerts, expected))
+    if alerts != expected:
+        print("FAILED")
+        sys.exit(1)
+
+
+def stream_elements(body, size):
+    """Elements decoded from body fed in chunks of size, and the error
+    raised by close, if any"""
+    elements = []
+    parser = ArrayStreamParser(elements.append)
+    try:
+        for chunk in chunked(body, size):
+            parser.feed(chunk)
+        parser.close()
+    except ValueError as ex:
+        return elements, ex
+    return elements, None
+
+
+def cmd_stream(args):
+    """Check the streaming parser against json.loads on every chunk size"""
+    logging.getLogger().setLevel(logging.CRITICAL)
+    valid = [
+        b'[]',
+        b' \n[ ]\n',
+        b'[1, 23, -4.5e6, true, null, "x"]',
+        b'[{"a": [1, {"b": "]}"}]}, {"c": "\\\\"}]',
+        u'[{"name": "S\u00e9rveur \u2013 \u6771\u4eac"}, 7]'.encode('utf-8'),
+        synthetic_payload(3),
+    ]
+    invalid = [
+        (b'[{"a": 1}, {"b"', 1),     # truncated element
+        (b'[{"a": 1}, 12', 1),        # trailing number without bracket
+        (b'[{"a": 1}', 0),            # missing closing bracket
+        (b'{"a": 1}', 0),             # not an array
+        (b'', 0),
+    ]
+    failures = 0
+    for body in valid:
+        expected = json.loads(body.decode('utf-8'))
+        for size in range(1, len(body) + 1):
+            elements, error = stream_elements(body, size)
+            if error is not None or elements != expected:
+                failures += 1
+                print("FAILED %r in chunks of %d: %r, %s" % (
+                    body[:40], size, elements[:3], error))
+                break
+    for body, count in invalid:
+        for size in range(1, max(2, len(body) + 1)):
+            elements, error = stream_elements(body, size)
+            if error is None or len(elements) != count:
+                failures += 1
+                print("FAILED %r in chunks of %d: %d elements, %s" % (
+                    body, size, len(elements), error))
+                break
+    # a truncated payload is an endpoint error, fully evaluated next time
+    endpoint = Endpoint(url='truncated://', streaming=True)
+    endpoint.etag = 'stale'
+    crawler = Crawler(lambda changes: None, endpoints=[endpoint])
+    crawler.http_client = ReplayClient(Recording.__new__(Recording))
+    crawler.http_client.recording.bodies = [synthetic_payload(3)[:-20]]
+    crawler.http_client.recording.position = 0
+    errors = endpoint.errors.value
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(crawler.run(endpoint))
+    loop.close()
+    if endpoint.errors.value != errors + 1 or endpoint.etag is not None:
+        failures += 1
+        print("FAILED truncated payload not counted as an error")
+    print("%d valid and %d invalid payloads, every chunk size: %s" % (
+        len(valid), len(invalid), "%d FAILED" % failures if failures
+        else "ok"))
+    if failures:
+        sys.exit(1)
+
+
+def cmd_replay(args):
+    """Replay recorded responses through Crawler.run with a mock notifier"""
+    recording = Recording(args.directory)
+    IOLoop.current().run_sync(lambda: replay(args, recording))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    cmd = commands.add_parser('record', help=cmd_record.__doc__)
+    cmd.add_argument('directory')
+    cmd.add_argument('--url', default=Endpoint.DEFAULT_URL)
+    cmd.add_argument('--count', type=int, default=20)
+    cmd.add_argument('--interval', type=float, default=8,
+                     help='seconds between requests')
+    cmd.add_argument('--synthetic', type=int, default=0,
+                     help='write N-entry synthetic payloads, no network')
+    cmd.set_defaults(func=cmd_record)
+    cmd = commands.add_parser('replay', help=cmd_replay.__doc__)
+    cmd.add_argument('directory')
+    cmd.add_argument('--iterations', type=int, default=100)
+    cmd.add_argument('--speed', type=float, default=0,
+                     help='replay speed relative to recording, 0 for no delay')
+    cmd.add_argument('--no-server', action='store_true',
+                     help='inject a fake HTTP client instead of a local server')
+    cmd.add_argument('--streaming', action='store_true')
+    cmd.add_argument('--tracemalloc', action='store_true')
+    cmd.add_argument('--servers', nargs='*',
+                     help='track only these servers, all by default')
+    cmd.add_argument('--regions', nargs='*', default=['europe', 'canada'])
+    cmd.add_argument('--mirror-delays', nargs='*', type=float,
+                     help='serve from one stand-in mirror per delay '
+                     '(seconds), hedging requests between them')
+    cmd.add_argument('--stall', type=float, default=0,
+                     help='seconds a stalled stand-in response takes')
+    cmd.add_argument('--stall-rate', type=float, default=0,
+                     help='share of stand-in responses that stall')
+    cmd.add_argument('--hedge-min-delay', type=float, default=0.2)
+    cmd.set_defaults(func=cmd_replay)
+    cmd = commands.add_parser('parse', help=cmd_parse.__doc__)
+    cmd.add_argument('payloads', nargs='*', help='recorded API responses')
+    cmd.add_argument('--synthetic', type=int, default=0,
+                     help='generate a payload with N entries instead')
+    cmd.add_argument('--chunk-size', type=int, default=16384,
+                     help='bytes per chunk fed to the parser')
+    cmd.add_argument('--repeat', type=int, default=5)
+    cmd.set_defaults(func=cmd_parse)
+    cmd = commands.add_parser('loop', help=cmd_loop.__doc__)
+    cmd.add_argument('--endpoints', type=int, default=100)
+    cmd.add_argument('--interval', type=float, default=0.05,
+                     help='seconds between polls of each endpoint')
+    cmd.add_argument('--duration', type=float, default=5)
+    cmd.add_argument('--entries', type=int, default=10,
+                     help='entries in the stand-in payload')
+    cmd.add_argument('--loops', nargs='*', default=['asyncio', 'uvloop'])
+    cmd.set_defaults(func=cmd_loop)
+    cmd = commands.add_parser('flap', help=cmd_flap.__doc__)
+    cmd.add_argument('--confirm-polls', type=int, default=2)
+    cmd.add_argument('--pattern', default='0101101110',
+                     help='availability of each poll, 1 for available')
+    cmd.set_defaults(func=cmd_flap)
+    cmd = commands.add_parser('stream', help=cmd_stream.__doc__)
+    cmd.set_defaults(func=cmd_stream)
+    args = parser.parse_args()
+    if not getattr(args, 'func', None):
+        parser.print_help()
+        sys.exit(1)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
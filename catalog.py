@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Hardware catalog of the provider: names, specs and prices of offers,
+discovered instead of maintained by hand in mapping/server_types.json
+
+Print the offers of a catalog, fetched or from its cache:
+
+    python catalog.py --url "https://eu.api.ovh.com/1.0/order/catalog/public/eco?ovhSubsidiary=FR"
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from tornado.ioloop import IOLoop
+from tornado.httpclient import AsyncHTTPClient
+from metrics import REGISTRY
+
+_logger = logging.getLogger(__name__)
+
+# product pages by range, formatted with the fields of an offer, e.g.
+# "https://eco.ovhcloud.com/en/{range}/{plan}/"
+RANGE_URLS = {
+    'kimsufi': "https://www.kimsufi.com/en/servers.xml",
+    'soyoustart': "http://www.soyoustart.com/de/essential-server/",
+}
+
+
+def guess_range(hardware):
+    """Range of a hardware code missing from the catalog, from its name"""
+    if 'sys' in hardware or 'bk' in hardware:
+        return 'soyoustart'
+    return 'kimsufi'
+
+
+def offer_url(offer, templates=None):
+    """Product page of an offer"""
+    templates = templates or RANGE_URLS
+    template = templates.get(offer.get('range')) or \
+        RANGE_URLS.get(offer.get('range')) or RANGE_URLS['kimsufi']
+    return template.format_map(defaultdict(str, offer))
+
+
+def offer_specs(plan):
+    """Short description of the hardware of a catalog plan"""
+    technical = plan.get('blobs', {}).get('technical', {})
+    specs = []
+    cpu = technical.get('server', {}).get('cpu', {})
+    if cpu.get('model'):
+        specs.append(' '.join(filter(None, [cpu.get('brand'), cpu['model']])))
+    if technical.get('memory', {}).get('size'):
+        specs.append('%sGB' % technical['memory']['size'])
+    for disk in technical.get('storage', {}).get('disks', []):
+        specs.append('%sx%sGB %s' % (disk.get('number', 1),
+                                     disk.get('capacity', '?'),
+                                     disk.get('technology', '')))
+    if not specs and '|' in plan.get('invoiceName', ''):
+        return plan['invoiceName'].split('|', 1)[1].strip()
+    return ', '.join(spec.strip() for spec in specs)
+
+
+def offer_price(plan, currency=''):
+    """Lowest monthly renewal price of a catalog plan, None if unknown"""
+    prices = [pricing['price'] for pricing in plan.get('pricings', [])
+              if pricing.get('intervalUnit') == 'month' and
+              'renew' in pricing.get('capacities', ['renew']) and
+              pricing.get('price')]
+    if not prices:
+        return None
+    # catalog prices are in hundred-millionths of the currency
+    return ('%.2f %s' % (min(prices) / 1e8, currency)).strip()
+
+
+def parse_catalog(data, templates=None):
+    """Offers of a public catalog, by plan code as reported in the
+    'hardware' field of availabilities"""
+    currency = data.get('locale', {}).get('currencyCode', '')
+    offers = {}
+    for plan in data.get('plans', []):
+        code = plan.get('planCode')
+        if not code:
+            continue
+        name = plan.get('invoiceName', '').split('|')[0].strip() or code
+        offer = {
+            'plan': code,
+            'name': name,
+            'range': plan.get('blobs', {}).get('commercial', {}).get(
+                'range', guess_range(code)),
+            'specs': offer_specs(plan),
+            'price': offer_price(plan, currency),
+        }
+        offer['url'] = offer_url(offer, templates)
+        offers[code] = offer
+    return offers
+
+
+def merge_offers(catalog, server_types):
+    """Offers of every hardware code, the local server types overriding
+    catalog names"""
+    offers = dict(catalog)
+    for hardware, name in server_types.items():
+        if hardware in offers:
+            offers[hardware] = dict(offers[hardware], name=name)
+        else:
+            offer = {'plan': hardware, 'name': name,
+                     'range': guess_range(hardware)}
+            offer['url'] = offer_url(offer)
+            offers[hardware] = offer
+    return offers
+
+
+class Catalog(object):
+    """Provider catalog, cached to a JSON file.
+
+    The cache is used as long as it is younger than ttl seconds, then the
+    catalog is fetched and parsed in the background, polls go on with the
+    offers known meanwhile. A failed refresh is retried after retry
+    seconds, keeping the cached offers."""
+
+    def __init__(self, url, cache_file=None, ttl=86400, retry=600,
+                 templates=None, on_update=None):
+        self.url = url
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.retry = retry
+        self.templates = templates
+        self.on_update = on_update
+        self.offers = {}
+        self.fetched = 0
+        self.next_refresh = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.http_client = AsyncHTTPClient()
+        self.size = REGISTRY.gauge(
+            'catalog_offers', 'Offers in the hardware catalog')
+        self.age = REGISTRY.gauge(
+            'catalog_fetched_timestamp_seconds',
+            'Time the hardware catalog was fetched')
+        self.failures = REGISTRY.counter(
+            'catalog_refresh_failures_total', 'Failed catalog refreshes')
+
+    @classmethod
+    def from_config(cls, config, on_update=None):
+        return cls(config['catalog_url'],
+                   cache_file=config.get('catalog_cache', 'catalog.json'),
+                   ttl=config.get('catalog_ttl', 86400),
+                   templates=config.get('catalog_urls'),
+                   on_update=on_update)
+
+    def load_cache(self):
+        """Return the cached offers, empty if there is no cache"""
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file) as cache:
+                content = json.load(cache)
+        except (OSError, IOError, ValueError) as ex:
+            _logger.warning("Ignoring catalog cache %s: %s",
+                            self.cache_file, ex)
+            return {}
+        if content.get('url') != self.url:
+            return {}
+        self.offers = content['offers']
+        self.fetched = content['fetched']
+        for offer in self.offers.values():
+            # product pages may be configured otherwise since
+            offer['url'] = offer_url(offer, self.templates)
+        self.size.set(len(self.offers))
+        self.age.set(self.fetched)
+        _logger.info("Catalog: %s offers cached %.0f hours ago",
+                     len(self.offers), (time.time() - self.fetched) / 3600)
+        return self.offers
+
+    def save_cache(self):
+        tmp_path = self.cache_file + '.tmp'
+        with open(tmp_path, 'w') as cache:
+            json.dump({'url': self.url, 'fetched': self.fetched,
+                       'offers': self.offers}, cache)
+        os.rename(tmp_path, self.cache_file)
+
+    def start(self):
+        """Refresh the catalog when the cache expires, on the current
+        IOLoop"""
+        self.schedule(max(0, self.fetched + self.ttl - time.time()))
+
+    def schedule(self, delay):
+        self.next_refresh = IOLoop.current().call_later(delay, self.refresh)
+
+    async def refresh(self):
+        try:
+            resp = await self.http_client.fetch(self.url, request_timeout=60)
+            # catalogs weigh megabytes, parse them off the IOLoop
+            offers = await IOLoop.current().run_in_executor(
+                self.executor,
+                lambda: parse_catalog(json.loads(resp.body.decode('utf-8')),
+                                      self.templates))
+        except Exception as ex:
+            self.failures.inc()
+            _logger.error("Catalog refresh failed, retrying in %ss: %s",
+                          self.retry, ex)
+            self.schedule(self.retry)
+            return
+        if not offers:
+            _logger.error("Catalog %s lists no offers, keeping %s cached",
+                          self.url, len(self.offers))
+            self.schedule(self.retry)
+            return
+        # list new offers, unless all are
+        new = set(offers) - set(self.offers) if self.offers else ()
+        self.offers, self.fetched = offers, time.time()
+        self.size.set(len(offers))
+        self.age.set(self.fetched)
+        _logger.info("Catalog: %s offers%s", len(offers),
+                     ', new: %s' % ', '.join(sorted(offers[code]['name']
+                                                    for code in new))
+                     if new else '')
+        if self.cache_file:
+            self.executor.submit(self.save_cache)
+        if self.on_update is not None:
+            self.on_update(offers)
+        self.schedule(self.ttl)
+
+    def close(self):
+        if self.next_refresh is not None:
+            IOLoop.current().remove_timeout(self.next_refresh)
+        self.executor.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List catalog offers")
+    parser.add_argument('--url', required=True)
+    parser.add_argument('--cache', help='cache file, fetched if expired')
+    parser.add_argument('--ttl', type=int, default=86400)
+    args = parser.parse_args()
+    catalog = Catalog(args.url, args.cache, args.ttl)
+    if not catalog.load_cache() or \
+            time.time() - catalog.fetched > catalog.ttl:
+        IOLoop.current().run_sync(catalog.refresh)
+    catalog.close()
+    for code, offer in sorted(catalog.offers.items()):
+        print("%-16s %-12s %-10s %-14s %s" % (
+            code, offer['name'], offer['range'], offer['price'] or '',
+            offer['specs']))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    main()
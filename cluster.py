@@ -0,0 +1,253 @@
+"""Cluster mode: crawler replicas sharing work and sending each alert once"""
+
+import os
+import time
+import socket
+import sqlite3
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from tornado.gen import coroutine, Return
+from tornado.ioloop import PeriodicCallback
+from metrics import REGISTRY
+
+_logger = logging.getLogger(__name__)
+
+
+class ClusterBackend(object):
+    """Abstract coordination store shared by all nodes of a cluster"""
+
+    def heartbeat(self, node, ttl):
+        """Renew the lease of node, return the sorted ids of live nodes"""
+        raise NotImplementedError
+
+    def leave(self, node):
+        """Drop the lease of node so its work is taken over immediately"""
+        raise NotImplementedError
+
+    def claim(self, key, node, ttl):
+        """Atomically claim key for ttl seconds, True if node got it"""
+        raise NotImplementedError
+
+    def publish_states(self, states):
+        """Save a dict of state values"""
+        raise NotImplementedError
+
+    def load_states(self):
+        """Return the dict of all saved state values"""
+        raise NotImplementedError
+
+
+class SQLiteBackend(ClusterBackend):
+    """Backend for nodes running on one host, or sharing a filesystem
+    with working locks, coordinated through a SQLite file"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS nodes (node TEXT PRIMARY KEY, expires REAL);
+    CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, node TEXT,
+                                       expires REAL);
+    CREATE TABLE IF NOT EXISTS states (key TEXT PRIMARY KEY, value INTEGER,
+                                       ts REAL);
+    """
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=5, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+
+    def _transaction(self, *statements):
+        cursor = self.db.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            results = [cursor.execute(sql, params).rowcount
+                       for sql, params in statements]
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        return results
+
+    def heartbeat(self, node, ttl):
+        now = time.time()
+        self._transaction(
+            ("INSERT OR REPLACE INTO nodes VALUES (?, ?)", (node, now + ttl)),
+            ("DELETE FROM nodes WHERE expires < ?", (now,)),
+            ("DELETE FROM claims WHERE expires < ?", (now,)))
+        return [row[0] for row in
+                self.db.execute("SELECT node FROM nodes ORDER BY node")]
+
+    def leave(self, node):
+        self._transaction(("DELETE FROM nodes WHERE node = ?", (node,)))
+
+    def claim(self, key, node, ttl):
+        now = time.time()
+        results = self._transaction(
+            ("DELETE FROM claims WHERE key = ? AND expires < ?", (key, now)),
+            ("INSERT OR IGNORE INTO claims VALUES (?, ?, ?)",
+             (key, node, now + ttl)))
+        return results[1] == 1
+
+    def publish_states(self, states):
+        now = time.time()
+        cursor = self.db.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.executemany("INSERT OR REPLACE INTO states VALUES (?, ?, ?)",
+                           [(k, int(v), now) for k, v in states.items()])
+        cursor.execute("COMMIT")
+
+    def load_states(self):
+        return dict((key, bool(value)) for key, value in
+                    self.db.execute("SELECT key, value FROM states"))
+
+
+BACKENDS = {
+    'sqlite': SQLiteBackend,
+}
+
+
+def owner(key, nodes):
+    """Rendezvous hashing: the node with the highest weight for key owns
+    it, so a node joining or leaving only moves its own share of keys"""
+    return max(nodes, key=lambda node: hashlib.sha1(
+        ('%s/%s' % (node, key)).encode('utf-8')).digest())
+
+
+class Cluster(object):
+    """Membership, work sharding and alert deduplication for one node.
+
+    Nodes renew a lease every lease/3 seconds. Endpoints, or hardware codes
+    with shard_hardware, are split between live nodes; when a node stops
+    renewing its lease, its share moves to the others within one lease.
+    States are published to the backend so that a node taking over a share
+    knows what was already available, and every transition is claimed in
+    the backend before notifying, so that it is sent by one node only."""
+
+    def __init__(self, backend, node_id=None, lease=8, alert_window=60,
+                 shard_hardware=False):
+        self.backend = backend
+        self.node_id = node_id or '%s-%s' % (socket.gethostname(), os.getpid())
+        self.lease = lease
+        self.alert_window = alert_window
+        self.shard_hardware = shard_hardware
+        self.nodes = None
+        self.crawler = None
+        self.published = {}
+        self.periodic_cb = None
+        # a single thread, so backend calls never run concurrently
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.claim_failures = REGISTRY.counter(
+            'cluster_claim_failures_total',
+            'Transitions notified without a claim, the backend failing')
+
+    @classmethod
+    def from_config(cls, config):
+        backend = BACKENDS[config.get('cluster_backend', 'sqlite')](
+            config['cluster_url'])
+        return cls(backend,
+                   node_id=config.get('cluster_node_id'),
+                   lease=config.get('cluster_lease', 8),
+                   alert_window=config.get('cluster_alert_window', 60),
+                   shard_hardware=config.get('cluster_shard_hardware', False))
+
+    def start(self, crawler):
+        """Join the cluster and take a share of the crawler work"""
+        self.crawler = crawler
+        crawler.cluster = self
+        self.assign(self.backend.heartbeat(self.node_id, self.lease),
+                    self.backend.load_states())
+        self.periodic_cb = PeriodicCallback(self.heartbeat,
+                                            self.lease * 1000 / 3.0)
+        self.periodic_cb.start()
+
+    @coroutine
+    def heartbeat(self):
+        try:
+            nodes = yield self.executor.submit(
+                self.backend.heartbeat, self.node_id, self.lease)
+            if nodes != self.nodes:
+                states = yield self.executor.submit(self.backend.load_states)
+                self.assign(nodes, states)
+            yield self.publish()
+        except Exception as ex:
+            _logger.error("Cluster heartbeat failed: %s", ex)
+
+    def assign(self, nodes, states):
+        """Split endpoints or hardware codes between live nodes, and load
+        the states published by previous owners"""
+        _logger.info("Cluster nodes: %s", nodes)
+        self.nodes = nodes
+        crawler = self.crawler
+        self.share()
+        # keep the cells still in this node's share, so that they are not
+        # seen again as new, and take over what the previous owners knew.
+        # Cells of endpoints polled elsewhere are compared to their last
+        # known tier if this node polls them again
+        if crawler.owned_hardware is not None:
+            crawler.table.retain(crawler.owned_hardware)
+        for state, value in states.items():
+            if crawler.tracked_states is None or state in crawler.tracked_states:
+                crawler.STATES[state] = value
+        self.published = dict(crawler.STATES)
+
+    def share(self):
+        """Split endpoints or hardware codes between the known nodes, called
+        again when the crawler hardware codes change"""
+        crawler = self.crawler
+        if self.shard_hardware:
+            owned = frozenset(
+                hardware for hardware in crawler.SERVER_TYPES
+                if owner(hardware, self.nodes) == self.node_id)
+            if owned != crawler.owned_hardware:
+                # payloads skipped as unchanged were not evaluated for
+                # the hardware taken over
+                for endpoint in crawler.endpoints:
+                    endpoint.reset_validators()
+            crawler.owned_hardware = owned
+            _logger.info("Node %s evaluates %s hardware codes", self.node_id,
+                         len(crawler.owned_hardware))
+            return
+        for endpoint in crawler.endpoints:
+            enabled = owner(endpoint.name, self.nodes) == self.node_id
+            if enabled and not endpoint.enabled:
+                endpoint.reset_validators()
+            endpoint.enabled = enabled
+        _logger.info("Node %s polls %s", self.node_id,
+                     [e.name for e in crawler.endpoints if e.enabled])
+
+    @coroutine
+    def publish(self):
+        """Publish states that changed locally since the last heartbeat"""
+        changed = dict((state, value) for state, value
+                       in self.crawler.STATES.items()
+                       if self.published.get(state) != value)
+        if changed:
+            yield self.executor.submit(self.backend.publish_states, changed)
+            self.published.update(changed)
+
+    @coroutine
+    def claim_changes(self, changes):
+        """Keep the transitions this node is elected to notify. If the
+        backend fails, transitions are kept: better notified twice than
+        not at all"""
+        claimed = []
+        for state, message in changes:
+            try:
+                won = yield self.executor.submit(
+                    self.backend.claim, state, self.node_id,
+                    self.alert_window)
+            except Exception as ex:
+                self.claim_failures.inc()
+                _logger.error("Cannot claim %s, notifying it anyway: %s",
+                              state, ex)
+                won = True
+            if won:
+                claimed.append((state, message))
+            else:
+                _logger.info("%s already notified by another node", state)
+        raise Return(claimed)
+
+    def close(self):
+        if self.periodic_cb is not None:
+            self.periodic_cb.stop()
+        self.executor.shutdown(wait=True)
+        self.backend.leave(self.node_id)
@@ -6,14 +6,25 @@ on Kimsufi/OVH become available for purchase"""
 import json
 import sys
 import os
+import signal
+import asyncio
 import re
 import logging
-import importlib
+import hashlib
+import time
 import tornado.ioloop
-import tornado.web
 from tornado.httpclient import AsyncHTTPClient
 from tornado.httpclient import HTTPError
-from tornado.gen import coroutine
+from tornado.locks import Condition
+from subscriptions import SubscriptionManager
+from metrics import REGISTRY
+from state_index import StateIndex, StateTable, TIERS, TIER_IDS, AVAILABLE
+from json_stream import ArrayStreamParser
+from scheduler import Scheduler
+from hedging import MirrorSet
+from events import cell_event
+from policy import Hysteresis
+from catalog import merge_offers
 # Python 3 imports
 try:
     from urllib import quote
@@ -25,8 +36,9 @@ _logger = logging.getLogger(__name__)
 CURRENT_PATH = os.path.dirname(__file__)
 
 
-def parse_json_file(filename):
-    """open file and parse its content as json"""
+def read_json_file(filename):
+    """open file and parse its content as json, raise ValueError if it
+    is not valid"""
     with open(filename, 'r') as jsonfile:
         content = jsonfile.read()
         try:
@@ -35,104 +47,564 @@ def parse_json_file(filename):
             _logger.error(
                 "Parsing file %s failed. Check syntax with a JSON validator:"
                 "\nhttp://jsonlint.com/?json=%s", filename, quote(content))
-            sys.exit(1)
+            raise
     return result
 
 
+def parse_json_file(filename):
+    """open file and parse its content as json, exit if it is not valid"""
+    try:
+        return read_json_file(filename)
+    except ValueError:
+        sys.exit(1)
+
+
+MAPPING_FILES = (os.path.join(CURRENT_PATH, 'mapping/server_types.json'),
+                 os.path.join(CURRENT_PATH, 'mapping/regions.json'))
+
+
+def load_mappings(reader=parse_json_file):
+    """Return server types and regions mappings"""
+    return tuple(reader(filename) for filename in MAPPING_FILES)
+
+
+class StartupTimer(object):
+    """Time spent in each startup phase, logged once polling has begun"""
+
+    def __init__(self):
+        self.started = self.last = time.time()
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def log(self):
+        _logger.info("Started in %.0fms: %s",
+                     (self.last - self.started) * 1000,
+                     ', '.join('%s %.0fms' % (phase, elapsed * 1000)
+                               for phase, elapsed in self.phases))
+
+
+class Endpoint(object):
+    """Availability API endpoint polled on its own schedule"""
+
+    DEFAULT_URL = ("https://ca.ovh.com/engine/api/dedicated/server/availabilities?country=fra")
+
+    def __init__(self, url=DEFAULT_URL, interval=8, timeout=30,
+                 max_concurrency=1, name=None, streaming=False,
+                 scheduler=None, mirrors=None):
+        self.url = url
+        self.name = name or url
+        # optional MirrorSet of url and other hosts, hedged
+        self.mirrors = mirrors
+        if streaming and mirrors is not None:
+            _logger.warning("Streaming parse is disabled for %s, responses "
+                            "of its mirrors are buffered", self.name)
+            streaming = False
+        # parse entries while the response is downloading
+        self.streaming = streaming
+        self.interval = interval    # seconds between iterations
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency  # requests allowed in flight
+        self.scheduler = scheduler or Scheduler(interval, name=self.name)
+        self.in_flight = 0
+        self.http_errors = []
+        self.task = None        # asyncio task polling the endpoint
+        self.sleeping = False   # task waits for the next poll
+        self.enabled = True     # False when polled by another cluster node
+        self.evaluated = False  # a payload was evaluated since start
+        # validators of the last processed payload
+        self.etag = None
+        self.last_modified = None
+        self.body_hash = None
+        self.iterations = REGISTRY.counter(
+            'crawler_iterations_total', 'Crawler iterations run',
+            endpoint=self.name)
+        self.fetch_time = REGISTRY.histogram(
+            'crawler_fetch_seconds', 'Availability API response time',
+            endpoint=self.name)
+        self.parse_time = REGISTRY.histogram(
+            'crawler_parse_seconds', 'Time spent parsing and evaluating '
+            'the payload', endpoint=self.name)
+        self.payload_size = REGISTRY.gauge(
+            'crawler_payload_bytes', 'Size of the last payload',
+            endpoint=self.name)
+        self.errors = REGISTRY.counter(
+            'crawler_errors_total', 'Failed API requests', endpoint=self.name)
+        self.not_modified = REGISTRY.counter(
+            'crawler_iterations_skipped_total',
+            'Iterations skipped because the payload did not change',
+            endpoint=self.name, reason='not_modified')
+        self.unchanged = REGISTRY.counter(
+            'crawler_iterations_skipped_total',
+            'Iterations skipped because the payload did not change',
+            endpoint=self.name, reason='unchanged')
+
+    def reset_validators(self):
+        """Forget the last payload, so the next one is fully evaluated"""
+        self.etag = self.last_modified = self.body_hash = None
+
+    def request_headers(self):
+        """Conditional request headers, based on the last payload seen"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def fetch(self, http_client, **kwargs):
+        """Request the endpoint, or the fastest of its mirrors"""
+        kwargs.update(headers=self.request_headers(),
+                      request_timeout=self.timeout)
+        if self.mirrors is None:
+            return http_client.fetch(self.url, **kwargs)
+        return self.mirrors.fetch(http_client, **kwargs)
+
+    def is_unchanged(self, resp):
+        """Remember validators of the response, tell if it was seen before"""
+        self.etag = resp.headers.get('Etag')
+        self.last_modified = resp.headers.get('Last-Modified')
+        if self.streaming:
+            # body was consumed while streaming, nothing to compare
+            return False
+        body_hash = hashlib.sha1(resp.body).digest()
+        if body_hash == self.body_hash:
+            return True
+        self.body_hash = body_hash
+        return False
+
+    @classmethod
+    def from_config(cls, config):
+        """Build the list of endpoints from user config.
+
+        Without an 'endpoints' list, a single default endpoint is polled
+        using the global 'crawler_interval', 'request_timeout' and
+        'mirrors'."""
+        interval = config.get('crawler_interval', 8)
+        timeout = config.get('request_timeout', 30)
+        streaming = config.get('streaming_parse', False)
+
+        def mirror_set(url, mirrors, name):
+            if not mirrors:
+                return None
+            return MirrorSet.from_config([url] + mirrors, config, name=name)
+        if 'endpoints' not in config:
+            return [cls(interval=interval, timeout=timeout,
+                        streaming=streaming,
+                        scheduler=Scheduler.from_config(
+                            interval, config, name=cls.DEFAULT_URL),
+                        mirrors=mirror_set(cls.DEFAULT_URL,
+                                           config.get('mirrors'),
+                                           cls.DEFAULT_URL))]
+        return [cls(url=ep['url'],
+                    interval=ep.get('interval', interval),
+                    timeout=ep.get('timeout', timeout),
+                    max_concurrency=ep.get('max_concurrency', 1),
+                    name=ep.get('name'),
+                    streaming=ep.get('streaming', streaming),
+                    scheduler=Scheduler.from_config(
+                        ep.get('interval', interval), config,
+                        name=ep.get('name') or ep['url']),
+                    mirrors=mirror_set(ep['url'], ep.get('mirrors'),
+                                       ep.get('name') or ep['url']))
+                for ep in config['endpoints']]
+
+
 class Crawler(object):
     """Crawler responsible for fetching availability and monitoring states"""
 
-    def __init__(self, state_change_callback):
+    def __init__(self, state_change_callback, endpoints=None,
+                 tracked_states=None, history=None, confirm_polls=1):
         # set properties
         self.state_change_callback = state_change_callback
+        self.endpoints = endpoints or [Endpoint()]
+        self.history = history
+        self.events = None      # optional EventHub publishing cell changes
+        self.cluster = None     # optional Cluster sharing the work
 
-        # load mappings
-        self.SERVER_TYPES = parse_json_file(
-            os.path.join(CURRENT_PATH, 'mapping/server_types.json'))
-        self.REGIONS = parse_json_file(
-            os.path.join(CURRENT_PATH, 'mapping/regions.json'))
+        # load mappings, local server types override the provider catalog
+        self.server_types, self.REGIONS = load_mappings()
+        self.catalog = {}
+        self.offers = merge_offers(self.catalog, self.server_types)
+        self.SERVER_TYPES = dict((hardware, offer['name'])
+                                 for hardware, offer in self.offers.items())
+        # compile them into lookups restricted to the tracked states
+        self.index = StateIndex(self.SERVER_TYPES, self.REGIONS,
+                                tracked_states, self.offers)
+        self.tracked_states = tracked_states
 
         # set private vars
-        self.API_URL = ("https://ca.ovh.com/engine/api/dedicated/server/availabilities?country=fra")
-        self.STATES = {}
-        self.HTTP_ERRORS = []
-        self.interval = 8   # seconds between interations
-        self.periodic_cb = None
-        self.ioloop = None
+        self.STATES = dict((state, False) for state in self.index.states())
+        self.table = StateTable(self.index)    # tier of every cell
+        self.changes = []   # transitions detected during current iteration
+        # state -> time its availability started, None if it was already
+        # available in the first payload evaluated, i.e. maybe notified
+        # before a restart
+        self.episodes = {}
+        self.hysteresis = Hysteresis(confirm_polls)
+        self.flips = 0      # state changes in either direction, ever
+        self.owned_hardware = None  # hardware evaluated by this cluster node
+        self.unknown_hardware = {}  # codes missing from mappings -> places
+        self.running = False
+        self.polls = set()  # overlapping iterations in flight
+        self.iteration_done = Condition()
+        self.states_tracked = REGISTRY.gauge(
+            'crawler_states_tracked', 'Number of states tracked')
+        self.transitions = REGISTRY.counter(
+            'crawler_transitions_total', 'States that became available')
+        self.unknown_codes = REGISTRY.gauge(
+            'crawler_unknown_hardware_codes',
+            'Hardware codes seen in the API but missing from the mappings')
         self.http_client = AsyncHTTPClient()
 
-    def update_state(self, state, value, message=None):
-        """Update state of particular event"""
+    def update_state(self, state, value, message=None, endpoint=None):
+        """Update state of particular event, seen in a poll of endpoint"""
         # if state is new, init it as False
         if state not in self.STATES:
             self.STATES[state] = False
         # compare new value to old value
         if value is not self.STATES[state]:
             _logger.debug("State change - %s: %s", state, value)
-        # notify, if state changed from False to True
+            self.flips += 1
+        # collect for notification, if state changed from False to True
+        # and is confirmed, forget unconfirmed ones changing back
         if value and not self.STATES[state]:
-            self.state_change_callback(state, message)
+            self.episodes[state] = time.time() \
+                if endpoint is not None and endpoint.evaluated else None
+            if self.hysteresis.rise(state, message, endpoint):
+                self.changes.append((state, message))
+        elif not value and self.STATES[state]:
+            self.episodes.pop(state, None)
+            self.hysteresis.fall(state)
         # save the new value
         self.STATES[state] = value
 
-    def resume_periodic_cb(self):
+    def set_tracked_states(self, tracked_states):
+        """Recompile the index for a new set of tracked states"""
+        if tracked_states == self.tracked_states:
+            return
+        self.rebuild_index(tracked_states)
+
+    def reload_mappings(self):
+        """Swap in mappings changed on disk, return True if they did"""
+        try:
+            server_types, regions = load_mappings(read_json_file)
+        except (OSError, IOError, ValueError) as ex:
+            _logger.error("Cannot reload mappings, keeping current ones: %s",
+                          ex)
+            return False
+        if server_types == self.server_types and regions == self.REGIONS:
+            return False
+        self.server_types, self.REGIONS = server_types, regions
+        self.merge_catalog(force=True)
+        _logger.info("Reloaded mappings: %s server types, %s regions",
+                     len(server_types), len(regions))
+        return True
+
+    def set_catalog(self, offers):
+        """Merge offers of the provider catalog into the hardware lookup"""
+        self.catalog = offers
+        if self.merge_catalog():
+            _logger.info("Tracking %s server types from the catalog",
+                         len(self.SERVER_TYPES))
+
+    def merge_catalog(self, force=False):
+        """Rebuild the hardware lookup from the catalog and the local
+        server types, return True if it changed"""
+        offers = merge_offers(self.catalog, self.server_types)
+        if offers == self.offers and not force:
+            return False
+        self.offers = offers
+        self.SERVER_TYPES = dict((hardware, offer['name'])
+                                 for hardware, offer in offers.items())
+        if self.cluster is not None and self.owned_hardware is not None:
+            # share new hardware codes, forget removed ones
+            self.cluster.share()
+        self.rebuild_index(self.tracked_states)
+        for hardware in list(self.unknown_hardware):
+            if hardware in self.SERVER_TYPES:
+                del self.unknown_hardware[hardware]
+        self.unknown_codes.set(len(self.unknown_hardware))
+        return True
+
+    def rebuild_index(self, tracked_states):
+        """Recompile the index from the mappings and tracked states"""
+        self.index = StateIndex(self.SERVER_TYPES, self.REGIONS,
+                                tracked_states, self.offers)
+        self.tracked_states = tracked_states
+        indexed = frozenset(self.index.states())
+        for state in list(self.STATES):
+            if state not in indexed:
+                del self.STATES[state]
+        # states new to the index are derived from the known cells, and
+        # notified with the next report if already available
+        for state_id, value, message in self.table.reindex(self.index):
+            self.update_state(state_id, value, message)
+        # next payload must be evaluated even if it did not change
+        for endpoint in self.endpoints:
+            endpoint.reset_validators()
+
+    def restore(self):
+        """Restore availabilities and states from history, without
+        notifying, so that servers already available do not re-alert"""
+        for state_id, value, _ in self.table.load(self.history.last_cells()):
+            self.STATES[state_id] = value
+        restock_hours = self.history.restock_hours()
+        for endpoint in self.endpoints:
+            endpoint.scheduler.restock_hours = list(restock_hours)
+        _logger.info("Restored %s cells from history", len(self.table.tiers))
+
+    def start(self):
+        """Poll every endpoint in its own task on the running loop"""
+        self.resume()
+
+    def set_endpoints(self, endpoints):
+        """Poll new endpoints instead of the current ones, keeping the
+        restock statistics of their schedulers"""
+        running = self.running
+        self.pause()
+        for endpoint in endpoints:
+            endpoint.scheduler.restock_hours = list(
+                self.endpoints[0].scheduler.restock_hours)
+        removed = set(endpoint.name for endpoint in self.endpoints) - \
+            set(endpoint.name for endpoint in endpoints)
+        self.endpoints = endpoints
+        # availabilities reported by removed endpoints no longer count
+        record = self.record_cell if self.history is not None or \
+            self.events is not None else None
+        for state_id, value, message in self.table.forget(removed, record):
+            self.update_state(state_id, value, message)
+        if running:
+            self.resume()
+
+    def reload_endpoints(self, config):
+        self.set_endpoints(Endpoint.from_config(config))
+
+    def pause(self):
+        """Stop scheduling polls, iterations in flight are completed"""
+        _logger.info("Crawler paused")
+        self.running = False
+        for endpoint in self.endpoints:
+            if endpoint.sleeping:
+                endpoint.task.cancel()
+                endpoint.task = None
+
+    def resume(self):
         _logger.info("Crawler resumed")
-        self.periodic_cb.start()
+        self.running = True
+        for endpoint in self.endpoints:
+            if endpoint.task is None or endpoint.task.done():
+                endpoint.task = asyncio.ensure_future(self.tick(endpoint))
+
+    async def stop(self, timeout=10):
+        """Stop polling, give iterations in flight timeout seconds to
+        complete and report their changes, then cancel them"""
+        tasks = set(self.polls)
+        tasks.update(endpoint.task for endpoint in self.endpoints
+                     if endpoint.task is not None)
+        self.pause()
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            _logger.warning("Cancelled %s iteration(s) in flight",
+                            len(pending))
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def tick(self, endpoint):
+        """Poll endpoint until paused, on the delays of its scheduler.
+
+        Each delay is counted from the start of the previous iteration.
+        Unless overlapping requests are allowed, the next iteration never
+        starts before the previous one is finished."""
+        while self.running and endpoint in self.endpoints:
+            started = time.time()
+            if not endpoint.enabled:
+                # keep ticking, to take the endpoint over without delay
+                pass
+            elif endpoint.max_concurrency > 1:
+                poll = asyncio.ensure_future(self.poll(endpoint))
+                self.polls.add(poll)
+                poll.add_done_callback(self.polls.discard)
+            else:
+                await self.poll(endpoint)
+            if not (self.running and endpoint in self.endpoints):
+                break
+            delay = endpoint.scheduler.next_delay()
+            endpoint.sleeping = True
+            try:
+                await asyncio.sleep(max(0, delay - (time.time() - started)))
+            finally:
+                endpoint.sleeping = False
 
-    @coroutine
-    def run(self):
+    async def poll(self, endpoint):
+        """Run an iteration for endpoint, unless its concurrency cap is hit"""
+        if endpoint.in_flight >= endpoint.max_concurrency:
+            _logger.debug("Skipping %s, %s requests in flight",
+                          endpoint.name, endpoint.in_flight)
+            return
+        endpoint.in_flight += 1
+        try:
+            await self.run(endpoint)
+        except Exception:
+            endpoint.errors.inc()
+            endpoint.scheduler.record_error()
+            _logger.exception("Iteration of %s failed", endpoint.name)
+        finally:
+            endpoint.in_flight -= 1
+            self.iteration_done.notify_all()
+
+    async def run(self, endpoint=None):
         """Run a crawler iteration"""
+        endpoint = endpoint or self.endpoints[0]
+        endpoint.iterations.inc()
         progress()
+        parser = None
+        kwargs = {}
+        if endpoint.streaming:
+            # evaluate entries as they arrive instead of buffering the body
+            parser = ArrayStreamParser(
+                lambda entry: self.process_entry(entry, endpoint))
+            kwargs['streaming_callback'] = parser.feed
+        started = time.time()
         try:
             # request OVH availability API asynchronously
-            resp = yield self.http_client.fetch(self.API_URL,
-                                                request_timeout=REQUEST_TIMEOUT)
+            resp = await endpoint.fetch(self.http_client, **kwargs)
         except HTTPError as ex:
+            if ex.code == 304:
+                # Not Modified, nothing to parse
+                endpoint.fetch_time.observe(time.time() - started)
+                endpoint.not_modified.inc()
+                endpoint.scheduler.record_success()
+                del endpoint.http_errors[:]
+                self.report_changes(endpoint)
+                return
             # Internal Server Error
-            self.HTTP_ERRORS.append(ex)
-            if len(self.HTTP_ERRORS) > 5:
-                if all([e.code == 500 for e in self.HTTP_ERRORS]):
+            endpoint.errors.inc()
+            endpoint.scheduler.record_error()
+            endpoint.http_errors.append(ex)
+            if len(endpoint.http_errors) > 5:
+                if all([e.code == 500 for e in endpoint.http_errors]):
                     _logger.error("Server continiously returns error 500 and "
                                   "may be down, check the status manually: %s",
-                                  self.API_URL)
+                                  endpoint.url)
                 else:
-                    _logger.error("Too many HTTP Errors: %s", self.HTTP_ERRORS)
-                self.HTTP_ERRORS = []
+                    _logger.error("Too many HTTP Errors: %s", endpoint.http_errors)
+                endpoint.http_errors = []
             return
         except Exception as gex:
             # Also catch other errors.
+            endpoint.errors.inc()
+            endpoint.scheduler.record_error()
             _logger.error("Socket Error: %s", str(gex))
             return
-        if self.HTTP_ERRORS:
-            del self.HTTP_ERRORS[:]
-        response_json = json.loads(resp.body.decode('utf-8'))
-        # check for error
-        if not response_json:
-            _logger.error("No answer from API: %s", response_json)
+        fetched = time.time()
+        endpoint.fetch_time.observe(fetched - started)
+        if endpoint.http_errors:
+            del endpoint.http_errors[:]
+        # same payload as last time, states cannot have changed
+        if endpoint.is_unchanged(resp):
+            endpoint.unchanged.inc()
+            endpoint.scheduler.record_success()
+            self.report_changes(endpoint)
             return
-        # parse
-        for entry in response_json:
-            server_type = self.SERVER_TYPES.get(entry['hardware'])
-            if not server_type:
-                continue
-            available_zones = set([
-                e['datacenter'] for e in entry['datacenters']
-                if e['availability'] not in ['unavailable', 'unknown']])
-            _logger.debug('%s is available in %s', server_type, available_zones)
-            
-            for region, places in self.REGIONS.items():
-                server_available = bool(available_zones.intersection(places))
-                state_id = '%s_available_in_%s' % (server_type.lower(),
-                                                   region.lower())
-                message = {
-                    'title': "{0} is available".format(server_type),
-                    'text': "Server {server} is available in {region}".format(
-                        server=server_type, region=region.capitalize()),
-                    'url': "https://www.kimsufi.com/en/servers.xml"
-                }
-                if 'sys' in entry['hardware'] or 'bk' in entry['hardware']:
-                    message['url'] = 'http://www.soyoustart.com/de/essential-server/'
-                self.update_state(state_id, server_available, message)
+        flips, restocks = self.flips, len(self.changes)
+        if parser is not None:
+            try:
+                parser.close()
+            except ValueError as ex:
+                self.reject_payload(endpoint, ex)
+                return
+            endpoint.payload_size.set(parser.size)
+            endpoint.parse_time.observe(parser.elapsed)
+            if not parser.count:
+                _logger.error("No answer from API: %s", [])
+                return
+        else:
+            endpoint.payload_size.set(len(resp.body))
+            try:
+                response_json = json.loads(resp.body.decode('utf-8'))
+            except ValueError as ex:
+                self.reject_payload(endpoint, ex)
+                return
+            # check for error
+            if not response_json:
+                _logger.error("No answer from API: %s", response_json)
+                return
+            for entry in response_json:
+                self.process_entry(entry, endpoint)
+            endpoint.parse_time.observe(time.time() - fetched)
+        self.states_tracked.set(len(self.STATES))
+        endpoint.evaluated = True
+        endpoint.scheduler.record_success(flips=self.flips - flips,
+                                          restocks=len(self.changes) - restocks)
+        self.report_changes(endpoint)
+
+    def reject_payload(self, endpoint, ex):
+        """Count a truncated or malformed payload as an error. Entries
+        decoded before the error were applied, the next payload is
+        evaluated in full"""
+        endpoint.errors.inc()
+        endpoint.scheduler.record_error()
+        endpoint.reset_validators()
+        _logger.error("Malformed payload from %s: %s", endpoint.name, ex)
+
+    def process_entry(self, entry, endpoint=None):
+        """Update the cells of one API entry of endpoint, and the states
+        derived from the cells that changed. Untracked hardware is dropped
+        by the index"""
+        if entry['hardware'] not in self.SERVER_TYPES:
+            # unknown codes are never owned, every node reports them
+            self.report_unknown(entry)
+            return
+        if self.owned_hardware is not None and \
+                entry['hardware'] not in self.owned_hardware:
+            return
+        record = None
+        if self.history is not None or self.events is not None:
+            record = self.record_cell
+        for state_id, server_available, message in \
+                self.table.update(entry, record,
+                                  endpoint and endpoint.name):
+            self.update_state(state_id, server_available, message, endpoint)
+
+    def report_unknown(self, entry):
+        """Warn once about a hardware code missing from the mappings"""
+        hardware = entry['hardware']
+        if hardware in self.unknown_hardware:
+            return
+        datacenters = sorted(dc['datacenter'] for dc in entry['datacenters'])
+        self.unknown_hardware[hardware] = datacenters
+        self.unknown_codes.set(len(self.unknown_hardware))
+        _logger.warning("Unknown hardware code %s (datacenters: %s), add it "
+                        "to mapping/server_types.json to track it",
+                        hardware, ', '.join(datacenters))
+
+    def record_cell(self, hardware, datacenter, availability, previous):
+        """Save a change of availability of a cell to history, and publish
+        it as an event unless the cell was never seen before"""
+        if self.history is not None:
+            self.history.record(hardware, datacenter, availability, previous)
+        if self.events is not None and previous is not None:
+            self.events.publish(cell_event(
+                hardware, self.SERVER_TYPES.get(hardware), datacenter,
+                availability, TIERS[TIER_IDS.get(availability, AVAILABLE)],
+                previous))
+
+    def report_changes(self, endpoint=None):
+        """Pass transitions collected since the last report, and those
+        confirmed by this poll of endpoint, to the callback"""
+        self.changes.extend(self.hysteresis.tick(endpoint))
+        # report all transitions of this iteration as one change-set
+        if self.changes:
+            changes, self.changes = self.changes, []
+            self.transitions.inc(len(changes))
+            self.state_change_callback(changes)
 
 
 def bell():
@@ -146,67 +618,214 @@ def progress():
 
 
 if __name__ == "__main__":
+    TIMER = StartupTimer()
     # load user config
     _CONFIG = parse_json_file(os.path.join(CURRENT_PATH, 'config.json'))
+    TIMER.mark('config')
+
+    # Tornado and the crawler run on any asyncio loop, uvloop if selected
+    if _CONFIG.get('event_loop') == 'uvloop':
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            _logger.warning("uvloop is not installed, using asyncio's loop")
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+    # a single pooled HTTP client is shared by the crawler and the HTTP
+    # notifiers, curl also keeps connections alive if pycurl is installed
+    try:
+        import pycurl
+        AsyncHTTPClient.configure(
+            'tornado.curl_httpclient.CurlAsyncHTTPClient',
+            max_clients=_CONFIG.get('http_max_clients', 20))
+    except ImportError:
+        AsyncHTTPClient.configure(
+            None, max_clients=_CONFIG.get('http_max_clients', 20))
+    TIMER.mark('http client')
 
-    # init notifier
-    _NOTIFIERS = {
-        'pushover': 'notifiers.pushover_notifier.PushoverNotifier',
-        'email': 'notifiers.email_notifier.EmailNotifier',
-        'osx': 'notifiers.osx_notifier.OSXNotifier',
-        'popup': 'notifiers.popup_notifier.PopupNotifier',
-        'popup_pywin': 'notifiers.popup_pywin_notifier.PopupPywinNotifier',
-        'smsapi': 'notifiers.smsapi_notifier.SmsApiNotifier',
-        'xmpp': 'notifiers.xmpp_notifier.XMPPNotifier',
-        'pushbullet': 'notifiers.pushbullet_notifier.PushbulletNotifier',
-        'file': 'notifiers.file_notifier.FileNotifier',
-        'freemobile': 'notifiers.freemobile_notifier.FreemobileNotifier',
-        'telegram': 'notifiers.telegram_notifier.TelegramNotifier',
-    }
     # Select notifier, 'email' by default
-    if 'notifier' not in _CONFIG:
+    if 'notifier' not in _CONFIG and 'servers' in _CONFIG:
         _logger.warning("No notifier selected in config, 'email' will be used")
         _CONFIG['notifier'] = 'email'
-    # Instantiate notifier class dynamically
+
+    # subscriptions route transitions to their notifiers, the crawler
+    # only evaluates states tracked by at least one of them
+    crawler = None
+
+    # optional orders fired on transitions, before any notification
+    AUTOBUY = None
+    if _CONFIG.get('autobuy'):
+        from autobuy import AutoBuyer
+        try:
+            AUTOBUY = AutoBuyer.from_config(_CONFIG)
+        except Exception as ex:
+            _logger.exception("Auto-buy setup failed, check config for errors")
+            sys.exit(1)
+
+    def all_tracked(states):
+        if AUTOBUY is not None:
+            states = states | AUTOBUY.states
+        return states
+
+    def tracked_states_changed(states):
+        _logger.info('Tracking states: %s', sorted(states))
+        if crawler is not None:
+            crawler.set_tracked_states(all_tracked(states))
+
+    # with fast_start, notifiers are checked in the background while
+    # the crawler already polls, alerts wait for the check to complete
+    if _CONFIG.get('fast_start'):
+        _logger.info("Fast start: checking notifiers in the background")
+    SUBSCRIPTIONS = SubscriptionManager(_CONFIG, tracked_states_changed)
     try:
-        _NOTIFIER_PATH = _NOTIFIERS[_CONFIG['notifier']]
-        _NOTIFIER_FILE, _NOTIFIER_CLASSNAME = _NOTIFIER_PATH.rsplit('.', 1)
-        _NOTIFIER_MODULE = importlib.import_module(_NOTIFIER_FILE)
-        NOTIFIER = getattr(_NOTIFIER_MODULE, _NOTIFIER_CLASSNAME)(_CONFIG)
+        # the user config itself is the default subscription
+        if 'servers' in _CONFIG:
+            SUBSCRIPTIONS.load([dict(name='default')])
+        # many more may be defined in a hot-reloaded file
+        if _CONFIG.get('subscriptions_file'):
+            SUBSCRIPTIONS.watch(_CONFIG['subscriptions_file'],
+                                _CONFIG.get('subscriptions_reload_interval', 5))
     except Exception as ex:
         _logger.exception("Notifier loading failed, check config for errors")
         sys.exit(1)
+    TIMER.mark('notifiers')
 
-    # prepare states tracked by the user
-    TRACKED_STATES = []
-    for server in _CONFIG['servers']:
-        TRACKED_STATES.append(
-            '%s_available_in_%s' % (server.lower(), _CONFIG['region'].lower()))
-    _logger.info('Tracking states: %s', TRACKED_STATES)
-
-    # define state-change callback to notify the user
-    def state_changed(state, message=None):
-        """Trigger notifications"""
-        message = message or {}
-        if state in TRACKED_STATES:
-            _logger.info("Will notify: %s", state)
-            NOTIFIER.notify(**message)
+    # optional cluster of crawlers sharing work and alerts
+    CLUSTER = None
+    if _CONFIG.get('cluster_url'):
+        from cluster import Cluster
+        CLUSTER = Cluster.from_config(_CONFIG)
+
+    def notify_users(changes):
+        """Trigger one notification per subscription for all transitions,
+        the crawler only reports tracked states"""
+        if AUTOBUY is not None:
+            AUTOBUY.trigger(changes)
+        if SUBSCRIPTIONS.notify(changes, crawler.episodes):
             bell()
 
-    # Check and set request timeout
-    REQUEST_TIMEOUT = _CONFIG.get('request_timeout', 30)
+    async def notify_cluster(changes):
+        """Notify only transitions this node is elected to send"""
+        try:
+            changes = await CLUSTER.claim_changes(changes)
+            notify_users(changes)
+        except Exception:
+            _logger.exception("Cannot notify %s transition(s)", len(changes))
 
-    # Init the crawler
-    crawler = Crawler(state_change_callback=state_changed)
-    crawler.periodic_cb = tornado.ioloop.PeriodicCallback(
-        crawler.run, crawler.interval * 1000)
-    crawler.periodic_cb.start()
+    # define state-change callback to notify the users
+    def state_changed(changes):
+        if CLUSTER is not None:
+            asyncio.ensure_future(notify_cluster(changes))
+        else:
+            notify_users(changes)
+
+    # optional availability history, also restores states on restart
+    HISTORY = None
+    if _CONFIG.get('history_file'):
+        from history import History
+        HISTORY = History(_CONFIG['history_file'],
+                          _CONFIG.get('history_flush_interval', 1))
+        TIMER.mark('history')
+
+    # Init the crawler, polling every endpoint on its own schedule
+    crawler = Crawler(state_change_callback=state_changed,
+                      endpoints=Endpoint.from_config(_CONFIG),
+                      tracked_states=all_tracked(
+                          SUBSCRIPTIONS.tracked_states()),
+                      history=HISTORY,
+                      confirm_polls=_CONFIG.get('confirm_polls', 1))
+    TIMER.mark('crawler')
+    # optional provider catalog, discovering hardware codes missing from
+    # the mappings, cached on disk and refreshed in the background
+    CATALOG = None
+    if _CONFIG.get('catalog_url'):
+        from catalog import Catalog
+        CATALOG = Catalog.from_config(_CONFIG, crawler.set_catalog)
+        crawler.set_catalog(CATALOG.load_cache())
+        CATALOG.start()
+        TIMER.mark('catalog')
+    if HISTORY is not None:
+        crawler.restore()
+        HISTORY.start()
+        TIMER.mark('restore')
+    if CLUSTER is not None:
+        CLUSTER.start(crawler)
+        TIMER.mark('cluster')
+    # optional live stream of cell changes, served on /events and posted
+    # in batches to webhooks
+    if _CONFIG.get('http_port') or _CONFIG.get('webhook_urls'):
+        from events import EventHub, WebhookSender
+        crawler.events = EventHub(_CONFIG.get('events_buffer_size', 1000))
+        if _CONFIG.get('webhook_urls'):
+            WebhookSender.from_config(crawler.events, _CONFIG).start()
+    crawler.start()
+    if AUTOBUY is not None:
+        AUTOBUY.start()
+
+    # optional metrics, states and profiling server on the same IOLoop
+    if _CONFIG.get('http_port'):
+        from webapp import start_server
+        start_server(crawler, _CONFIG['http_port'],
+                     _CONFIG.get('http_address', '127.0.0.1'))
+        TIMER.mark('http server')
+
+    # reload config.json and mappings when they change
+    RELOADER = None
+    if _CONFIG.get('config_reload_interval', 5):
+        from reloader import ConfigReloader
+        RELOADER = ConfigReloader(os.path.join(CURRENT_PATH, 'config.json'),
+                                  MAPPING_FILES, _CONFIG, crawler,
+                                  SUBSCRIPTIONS, CLUSTER,
+                                  _CONFIG.get('config_reload_interval', 5))
+        RELOADER.start()
+
+    async def log_startup():
+        await crawler.iteration_done.wait()
+        TIMER.mark('first poll')
+        TIMER.log()
+
+    async def shutdown():
+        """Complete iterations in flight and deliver their notifications"""
+        timeout = _CONFIG.get('shutdown_timeout', 10)
+        _logger.info("Shutting down within %ss, signal again to force", timeout)
+        await crawler.stop(timeout)
+        await SUBSCRIPTIONS.shutdown(timeout)
+        tornado.ioloop.IOLoop.current().stop()
+
+    SHUTDOWN = None
+
+    def request_shutdown():
+        global SHUTDOWN
+        if SHUTDOWN is None:
+            SHUTDOWN = asyncio.ensure_future(shutdown())
+        else:
+            tornado.ioloop.IOLoop.current().stop()
 
     # start the IOloop
     _logger.info("Starting main loop")
-    crawler.ioloop = tornado.ioloop.IOLoop.instance()
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, request_shutdown)
+        except NotImplementedError:
+            # no signal handlers on Windows, Ctrl+C stops right away
+            pass
+    asyncio.ensure_future(log_startup())
     try:
-        crawler.ioloop.start()
+        tornado.ioloop.IOLoop.current().start()
     except KeyboardInterrupt:
         _logger.info("Terminated by user. Bye.")
         sys.exit(0)
+    finally:
+        if RELOADER is not None:
+            RELOADER.stop()
+        if CATALOG is not None:
+            CATALOG.close()
+        if CLUSTER is not None:
+            CLUSTER.close()
+        SUBSCRIPTIONS.close()
+        if AUTOBUY is not None:
+            AUTOBUY.close()
+        if HISTORY is not None:
+            HISTORY.close()
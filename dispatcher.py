@@ -0,0 +1,238 @@
+"""Notification dispatcher: bounded queue between the crawler and notifiers"""
+
+import time
+import random
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+from tornado.locks import Event
+from tornado.queues import Queue, QueueFull
+from metrics import REGISTRY
+from outbox import idempotency_key
+
+_logger = logging.getLogger(__name__)
+
+
+class Dispatcher(object):
+    """Deliver notifications off the crawl loop.
+
+    Messages are put on a bounded queue and drained by a pool of workers.
+    Blocking notifiers run in a thread pool, notifiers returning futures
+    run natively on the IOLoop. Every delivery has a timeout and is retried
+    with exponential backoff.
+
+    Each queue item is a batch of messages sent as one notification.
+    With a coalescing window, batches submitted within the window are
+    merged before being queued.
+
+    With an outbox, batches are stored before being queued, and stay
+    there until delivered: a batch that failed every retry, or did not
+    fit in the queue, is queued again later by the outbox."""
+
+    def __init__(self, notifier, queue_size=100, workers=4, timeout=30,
+                 retries=3, backoff=2, coalesce_window=0, outbox=None,
+                 name='default'):
+        self.notifier = notifier
+        self.outbox = outbox
+        self.name = name
+        self.coalesce_window = coalesce_window
+        self.pending = []
+        self.pending_transitions = []
+        self.pending_timeout = None
+        self.queue = Queue(maxsize=queue_size)
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # cleared while the notifier is validated in the background,
+        # messages are queued meanwhile
+        self.ready = Event()
+        self.ready.set()
+        notifier_name = type(notifier).__name__
+        self.queue_depth = REGISTRY.gauge(
+            'notification_queue_depth', 'Notifications waiting for delivery',
+            subscription=name)
+        self.latency = REGISTRY.histogram(
+            'notification_delivery_seconds',
+            'Time from enqueue to successful delivery',
+            subscription=name, notifier=notifier_name)
+        self.failures = REGISTRY.counter(
+            'notification_failures_total',
+            'Failed delivery attempts',
+            subscription=name, notifier=notifier_name)
+        self.dropped = REGISTRY.counter(
+            'notification_dropped_total',
+            'Notifications dropped because the queue was full',
+            subscription=name)
+
+    @classmethod
+    def from_config(cls, notifier, config, outbox=None, name='default'):
+        """Build a dispatcher with settings taken from the user config"""
+        return cls(notifier, outbox=outbox, name=name,
+                   queue_size=config.get('notification_queue_size', 100),
+                   workers=config.get('notification_workers', 4),
+                   timeout=config.get('notification_timeout', 30),
+                   retries=config.get('notification_retries', 3),
+                   backoff=config.get('notification_retry_backoff', 2),
+                   coalesce_window=config.get('coalesce_window', 0))
+
+    def start(self):
+        """Spawn queue workers on the current IOLoop"""
+        for _ in range(self.workers):
+            IOLoop.current().spawn_callback(self._worker)
+        if self.outbox is not None:
+            self.outbox.register(self.name, self)
+
+    def submit(self, messages, transitions=()):
+        """Submit a batch of messages, coalescing it if a window is set.
+        Transitions are the (state, episode start) the messages alert of,
+        deduplicating them in the outbox"""
+        if not self.coalesce_window:
+            return self._enqueue(messages, transitions)
+        self.pending.extend(messages)
+        self.pending_transitions.extend(transitions)
+        if self.pending_timeout is None:
+            self.pending_timeout = IOLoop.current().call_later(
+                self.coalesce_window, self._flush_pending)
+        return True
+
+    def _flush_pending(self):
+        self.pending_timeout = None
+        messages, self.pending = self.pending, []
+        transitions, self.pending_transitions = self.pending_transitions, []
+        if messages:
+            self._enqueue(messages, transitions)
+
+    def _enqueue(self, messages, transitions=()):
+        if self.outbox is not None:
+            IOLoop.current().spawn_callback(self._store, messages,
+                                            transitions)
+            return True
+        return self.put(messages, key=idempotency_key(self.name, transitions)
+                        if transitions else None)
+
+    @coroutine
+    def _store(self, messages, transitions=()):
+        """Write a batch to the outbox, then queue it"""
+        try:
+            stored = yield self.outbox.add(self.name, messages, transitions)
+        except Exception as ex:
+            _logger.error("Cannot store notification in outbox: %s", ex)
+            rowid = key = None
+        else:
+            if stored is None:
+                # every alert was stored already
+                return
+            rowid, messages, key = stored
+        self.put(messages, rowid, key=key)
+
+    def put(self, messages, rowid=None, enqueued=None, key=None):
+        """Enqueue a batch without blocking. If the queue is full, the
+        batch is dropped, or left for a later attempt if stored in the
+        outbox. Key identifies the alerts of the batch across attempts"""
+        try:
+            self.queue.put_nowait((enqueued or time.time(), messages, rowid,
+                                   key))
+        except QueueFull:
+            if rowid is not None:
+                self.outbox.release(rowid)
+                _logger.warning("Notification queue is full, %s kept in "
+                                "outbox", rowid)
+                return False
+            self.dropped.inc()
+            _logger.error("Notification queue is full, dropping: %s",
+                          [m.get('title') for m in messages])
+            return False
+        self.queue_depth.set(self.queue.qsize())
+        return True
+
+    @coroutine
+    def _worker(self):
+        while True:
+            enqueued, messages, rowid, key = yield self.queue.get()
+            self.queue_depth.set(self.queue.qsize())
+            if messages is None:
+                # stop() sentinel
+                self.queue.task_done()
+                return
+            yield self.ready.wait()
+            try:
+                yield self._deliver(messages, key)
+                self.latency.observe(time.time() - enqueued)
+            except Exception as ex:
+                _logger.error("Notification of %s message(s) failed after "
+                              "%s attempts: %s", len(messages),
+                              self.retries + 1, ex)
+                if rowid is not None:
+                    self.outbox.failed(rowid)
+            else:
+                if rowid is not None:
+                    yield self._ack(rowid)
+            finally:
+                self.queue.task_done()
+
+    @coroutine
+    def _ack(self, rowid):
+        """Mark a row delivered before taking the next one, so that it is
+        not sent again after a crash"""
+        try:
+            yield self.outbox.delivered(rowid)
+        except Exception as ex:
+            _logger.error("Cannot mark notification %s delivered, it may "
+                          "be sent again: %s", rowid, ex)
+
+    @coroutine
+    def _deliver(self, messages, key=None):
+        attempt = 0
+        while True:
+            try:
+                yield gen.with_timeout(
+                    datetime.timedelta(seconds=self.timeout),
+                    self._call(messages, key))
+                return
+            except Exception as ex:
+                self.failures.inc()
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                delay += random.uniform(0, delay / 2.0)
+                _logger.warning("Notification attempt %s failed (%s), "
+                                "retrying in %.1fs", attempt + 1, ex, delay)
+                attempt += 1
+                yield gen.sleep(delay)
+
+    def _call(self, messages, key=None):
+        if key is not None and hasattr(self.notifier, 'notify_alert'):
+            # notifiers tracking alerts, e.g. to escalate them
+            return self.notifier.notify_alert(messages, key)
+        if len(messages) == 1:
+            func, args, kwargs = self.notifier.notify, (), messages[0]
+        else:
+            func, args, kwargs = self.notifier.notify_many, (messages,), {}
+        if self.notifier.blocking:
+            return self.executor.submit(func, *args, **kwargs)
+        return func(*args, **kwargs)
+
+    @coroutine
+    def flush(self, timeout=None):
+        """Wait until all queued notifications have been handled"""
+        if self.pending_timeout is not None:
+            IOLoop.current().remove_timeout(self.pending_timeout)
+            self._flush_pending()
+        if timeout is not None:
+            timeout = datetime.timedelta(seconds=timeout)
+        yield self.queue.join(timeout)
+
+    @coroutine
+    def stop(self, timeout=None):
+        """Deliver queued notifications, then stop the workers"""
+        if self.outbox is not None:
+            self.outbox.unregister(self.name, self)
+        yield self.flush(timeout)
+        for _ in range(self.workers):
+            yield self.queue.put((None, None, None, None))
+        self.executor.shutdown(wait=False)
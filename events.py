@@ -0,0 +1,143 @@
+"""Live stream of availability changes, for Server-Sent Events clients
+and outbound webhooks"""
+
+import json
+import time
+import logging
+import datetime
+from collections import deque
+from tornado import gen
+from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition
+from tornado.httpclient import AsyncHTTPClient
+from metrics import REGISTRY
+
+_logger = logging.getLogger(__name__)
+
+
+class EventHub(object):
+    """Ring buffer of the last events, numbered in sequence.
+
+    Publishing appends to the buffer and wakes readers once per IOLoop
+    iteration, whatever their number, so subscribers never slow down
+    polling. Each reader keeps its own position and catches up on its own
+    time; one falling behind the whole buffer skips the oldest events."""
+
+    def __init__(self, size=1000):
+        self.buffer = deque(maxlen=size)
+        self.seq = 0
+        self.condition = Condition()
+        self.wakeup_pending = False
+        self.published = REGISTRY.counter(
+            'events_published_total', 'Availability change events published')
+        self.subscribers = REGISTRY.gauge(
+            'events_subscribers', 'Connected event stream readers')
+        self.skipped = REGISTRY.counter(
+            'events_skipped_total', 'Events missed by slow readers')
+
+    def publish(self, event):
+        self.seq += 1
+        event['id'] = self.seq
+        self.buffer.append(event)
+        self.published.inc()
+        if not self.wakeup_pending:
+            self.wakeup_pending = True
+            IOLoop.current().add_callback(self._wakeup)
+
+    def _wakeup(self):
+        self.wakeup_pending = False
+        self.condition.notify_all()
+
+    def since(self, seq):
+        """Events published after seq"""
+        if not self.buffer or self.buffer[-1]['id'] <= seq:
+            return []
+        oldest = self.buffer[0]['id']
+        if seq + 1 < oldest:
+            self.skipped.inc(oldest - seq - 1)
+        return list(self.buffer)[max(0, seq + 1 - oldest):]
+
+    @coroutine
+    def wait(self, seq, timeout=None):
+        """Return events published after seq, waiting for some if needed,
+        an empty list on timeout"""
+        events = self.since(seq)
+        if not events:
+            if timeout is not None:
+                timeout = datetime.timedelta(seconds=timeout)
+            yield self.condition.wait(timeout)
+            events = self.since(seq)
+        raise Return(events)
+
+
+class WebhookSender(object):
+    """Post events in batches, as JSON {"events": [...]}, to webhook URLs.
+
+    Events are gathered for batch_interval seconds, or up to batch_size.
+    A failed batch is retried with backoff, events published meanwhile
+    join it, up to the size of the hub buffer."""
+
+    def __init__(self, hub, urls, batch_interval=1, batch_size=100,
+                 timeout=10, max_backoff=60):
+        self.hub = hub
+        self.urls = urls
+        self.batch_interval = batch_interval
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.http_client = AsyncHTTPClient()
+        self.failures = REGISTRY.counter(
+            'webhook_failures_total', 'Failed webhook deliveries')
+
+    @classmethod
+    def from_config(cls, hub, config):
+        return cls(hub, config['webhook_urls'],
+                   batch_interval=config.get('webhook_batch_interval', 1),
+                   batch_size=config.get('webhook_batch_size', 100),
+                   timeout=config.get('webhook_timeout', 10))
+
+    def start(self):
+        for url in self.urls:
+            IOLoop.current().spawn_callback(self.run, url)
+
+    @coroutine
+    def run(self, url):
+        """Deliver every event to one URL, in order"""
+        seq = self.hub.seq
+        backoff = 1
+        while True:
+            events = yield self.hub.wait(seq)
+            if len(events) < self.batch_size:
+                # gather more events into this batch
+                yield gen.sleep(self.batch_interval)
+                events = self.hub.since(seq)
+            events = events[:self.batch_size]
+            try:
+                yield self.http_client.fetch(
+                    url, method='POST', request_timeout=self.timeout,
+                    headers={'Content-Type': 'application/json'},
+                    body=json.dumps({'events': events}))
+            except Exception as ex:
+                self.failures.inc()
+                _logger.error("Webhook %s failed, retrying in %ss: %s",
+                              url, backoff, ex)
+                yield gen.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            backoff = 1
+            seq = events[-1]['id']
+
+
+def cell_event(hardware, server_type, datacenter, availability, tier,
+               previous):
+    """Structured change of availability of a (hardware, datacenter) cell"""
+    return {
+        'hardware': hardware,
+        'server': server_type,
+        'datacenter': datacenter,
+        'availability': availability,
+        'tier': tier,
+        'previous': previous,
+        'ts': time.time(),
+    }
@@ -0,0 +1,137 @@
+"""Hedged requests to mirrors of an availability API: a slow or stalled
+host delays detection by one hedge delay instead of the request timeout"""
+
+import time
+import logging
+import datetime
+from collections import deque
+from tornado import gen
+from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop
+from tornado.httpclient import HTTPError
+from tornado.queues import Queue
+from metrics import REGISTRY
+# Python 3 imports
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+
+_logger = logging.getLogger(__name__)
+
+
+class Mirror(object):
+    """Host serving the same data, with its recent latencies"""
+
+    def __init__(self, url, samples=100, endpoint=''):
+        self.url = url
+        self.host = urlsplit(url).netloc
+        self.latencies = deque(maxlen=samples)  # successful requests
+        self.failures = 0       # consecutive failed requests
+        self.gauge = REGISTRY.gauge(
+            'crawler_mirror_latency_seconds',
+            'Median of recent mirror response times',
+            endpoint=endpoint, host=self.host)
+        self.wins = REGISTRY.counter(
+            'crawler_mirror_wins_total', 'Hedged requests answered first',
+            endpoint=endpoint, host=self.host)
+
+    def observe(self, elapsed, ok=True):
+        if not ok:
+            self.failures += 1
+            return
+        self.failures = 0
+        self.latencies.append(elapsed)
+        self.gauge.set(self.percentile(50, 1))
+
+    def rank(self):
+        """Sort key, failing mirrors last, then by median latency, unknown
+        ones first so that each is measured"""
+        return (self.failures > 0, self.percentile(50, 1) or 0)
+
+    def percentile(self, point, min_samples=5):
+        """Nearest-rank percentile of recent latencies, None if too few"""
+        if len(self.latencies) < min_samples:
+            return None
+        values = sorted(self.latencies)
+        return values[min(len(values) - 1, int(len(values) * point / 100.0))]
+
+
+class MirrorSet(object):
+    """Fetch from the fastest mirror, hedging with the next ones.
+
+    Mirrors are ranked by median latency, failing ones last. A request is sent to the first; when it has not
+    answered within the hedge_percentile of its recent latencies, or
+    failed, the next mirror is requested too, and so on. The first answer
+    wins. Tornado cannot cancel a request in flight: the others are
+    abandoned, and only update the latencies of their mirror."""
+
+    def __init__(self, urls, percentile=95, min_delay=0.2, initial_delay=1,
+                 name=''):
+        self.mirrors = [Mirror(url, endpoint=name) for url in urls]
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.hedged = REGISTRY.counter(
+            'crawler_hedged_requests_total',
+            'Backup requests sent to another mirror', endpoint=name)
+
+    @classmethod
+    def from_config(cls, urls, config, name=''):
+        return cls(urls,
+                   percentile=config.get('hedge_percentile', 95),
+                   min_delay=config.get('hedge_min_delay', 0.2),
+                   initial_delay=config.get('hedge_initial_delay', 1),
+                   name=name)
+
+    def ranked(self):
+        return sorted(self.mirrors, key=Mirror.rank)
+
+    def hedge_delay(self, mirror):
+        delay = mirror.percentile(self.percentile)
+        if delay is None:
+            delay = self.initial_delay
+        return max(self.min_delay, delay)
+
+    def request(self, http_client, mirror, done, **kwargs):
+        started = time.time()
+
+        def finished(future):
+            ex = future.exception()
+            ok = ex is None or isinstance(ex, HTTPError) and ex.code == 304
+            mirror.observe(time.time() - started, ok)
+            done.put_nowait((mirror, future, ok))
+        IOLoop.current().add_future(http_client.fetch(mirror.url, **kwargs),
+                                    finished)
+
+    @coroutine
+    def fetch(self, http_client, **kwargs):
+        """Return the first response of a mirror, raise the error of the
+        last one if all failed. 304 Not Modified is an answer"""
+        mirrors = self.ranked()
+        done = Queue()
+        in_flight = 0
+        while True:
+            wait = None
+            if mirrors:
+                mirror = mirrors.pop(0)
+                if in_flight:
+                    self.hedged.inc()
+                    _logger.info("Hedging with %s", mirror.host)
+                self.request(http_client, mirror, done, **kwargs)
+                in_flight += 1
+                if mirrors:
+                    wait = datetime.timedelta(
+                        seconds=self.hedge_delay(mirror))
+            try:
+                mirror, future, ok = yield done.get(timeout=wait)
+            except gen.TimeoutError:
+                continue
+            in_flight -= 1
+            if ok:
+                mirror.wins.inc()
+                raise Return(future.result())
+            _logger.warning("Mirror %s failed: %s", mirror.host,
+                            future.exception())
+            if not mirrors and not in_flight:
+                raise future.exception()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Append-only history of availability changes, stored in SQLite
+
+Query it from the command line, e.g. restocks of KS-3A in rbx over the
+last 30 days:
+
+    python history.py history.sqlite KS-3A rbx --days 30
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from tornado.ioloop import PeriodicCallback
+from state_index import UNAVAILABLE
+
+_logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transitions (
+    ts REAL NOT NULL,
+    hardware TEXT NOT NULL,
+    datacenter TEXT NOT NULL,
+    availability TEXT NOT NULL,
+    restock INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transitions_cell
+    ON transitions (hardware, datacenter, restock, ts);
+"""
+
+
+class History(object):
+    """Record every availability change of a (hardware, datacenter) cell.
+
+    Rows are buffered in memory and written in batches by a single
+    background thread, so the IOLoop never waits on disk."""
+
+    def __init__(self, filename, flush_interval=1):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.periodic_cb = None
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def start(self):
+        """Flush buffered rows periodically on the current IOLoop"""
+        self.periodic_cb = PeriodicCallback(self.flush,
+                                            self.flush_interval * 1000)
+        self.periodic_cb.start()
+
+    def record(self, hardware, datacenter, availability, previous=None):
+        """Buffer a change of availability, previous being the last one.
+        A cell seen for the first time is recorded, not as a restock"""
+        restock = (availability not in UNAVAILABLE and
+                   previous is not None and previous in UNAVAILABLE)
+        self.pending.append(
+            (time.time(), hardware, datacenter, availability, int(restock)))
+
+    def flush(self):
+        """Write buffered rows in the background"""
+        if not self.pending:
+            return None
+        rows, self.pending = self.pending, []
+        return self.executor.submit(self._write, rows)
+
+    def _write(self, rows):
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO transitions VALUES (?, ?, ?, ?, ?)", rows)
+
+    def close(self):
+        """Write remaining rows and close the database"""
+        if self.periodic_cb is not None:
+            self.periodic_cb.stop()
+        self.flush()
+        self.executor.shutdown(wait=True)
+        self.db.close()
+
+    def last_cells(self):
+        """Return the last known availability of every cell"""
+        rows = self.db.execute(
+            "SELECT hardware, datacenter, availability FROM transitions "
+            "WHERE rowid IN (SELECT MAX(rowid) FROM transitions "
+            "GROUP BY hardware, datacenter)")
+        return dict(((hw, dc), availability) for hw, dc, availability in rows)
+
+    def restocks(self, hardware_codes, datacenter=None, since=None, until=None):
+        """Return timestamps at which any of hardware_codes became
+        available, optionally in one datacenter and a time range"""
+        query = ["SELECT ts FROM transitions WHERE hardware IN (%s) "
+                 "AND restock = 1" % ','.join('?' * len(hardware_codes))]
+        params = list(hardware_codes)
+        if datacenter:
+            query.append("AND datacenter = ?")
+            params.append(datacenter)
+        if since is not None:
+            query.append("AND ts >= ?")
+            params.append(since)
+        if until is not None:
+            query.append("AND ts < ?")
+            params.append(until)
+        query.append("ORDER BY ts")
+        return [ts for ts, in self.db.execute(' '.join(query), params)]
+
+    def restock_hours(self):
+        """Return the number of restocks per local hour of the day"""
+        hours = [0] * 24
+        rows = self.db.execute(
+            "SELECT CAST(strftime('%H', ts, 'unixepoch', 'localtime') "
+            "AS INTEGER), COUNT(*) FROM transitions WHERE restock = 1 "
+            "GROUP BY 1")
+        for hour, count in rows:
+            hours[hour] = count
+        return hours
+
+
+def main():
+    from crawler import parse_json_file, CURRENT_PATH
+    parser = argparse.ArgumentParser(description="Query restocks history")
+    parser.add_argument('filename')
+    parser.add_argument('server', help='server name, e.g. KS-3A')
+    parser.add_argument('datacenter', nargs='?', help='e.g. rbx')
+    parser.add_argument('--days', type=float, default=30)
+    args = parser.parse_args()
+    server_types = parse_json_file(
+        os.path.join(CURRENT_PATH, 'mapping/server_types.json'))
+    codes = [code for code, name in server_types.items()
+             if name.lower() == args.server.lower()]
+    history = History(args.filename)
+    started = time.time()
+    restocks = history.restocks(codes, args.datacenter,
+                                since=started - args.days * 86400)
+    print("%d restocks of %s in %s over the last %g days (%.1fms)" % (
+        len(restocks), args.server, args.datacenter or 'all datacenters',
+        args.days, (time.time() - started) * 1000))
+    for ts in restocks:
+        print(time.strftime('  %Y-%m-%d %H:%M:%S', time.localtime(ts)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Incremental parser for a JSON array delivered in chunks"""
+
+import json
+import time
+import codecs
+
+_WHITESPACE = ' \t\n\r'
+
+
+class ArrayStreamParser(object):
+    """Decode the elements of a top-level JSON array as chunks arrive.
+
+    Each complete element is passed to callback as soon as its closing
+    character has been received, and its text is then discarded, so the
+    whole payload is never held in memory at once."""
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.count = 0      # elements decoded so far
+        self.size = 0       # bytes received
+        self.elapsed = 0.0  # seconds spent parsing and in callbacks
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._started = False   # opening bracket seen
+        self._done = False      # closing bracket seen
+        self._stalled = False   # last decode attempt needed more data
+
+    def feed(self, chunk):
+        """Add a chunk of raw bytes, used as tornado streaming_callback"""
+        started = time.time()
+        try:
+            self._feed(chunk)
+        finally:
+            self.elapsed += time.time() - started
+
+    def _feed(self, chunk):
+        self.size += len(chunk)
+        text = self._text.decode(chunk)
+        if self._done or not text:
+            return
+        # a stalled element resumes with the next closing character, the
+        # array is re-parsed in full on close
+        if self._stalled and '}' not in text and ']' not in text:
+            self._buffer += text
+            return
+        self._buffer += text
+        self._parse()
+
+    def _parse(self):
+        buf = self._buffer
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            if pos == len(buf):
+                break
+            if not self._started:
+                if buf[pos] != '[':
+                    raise ValueError("Expected JSON array, got %r" % buf[pos])
+                self._started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                self._done = True
+                pos += 1
+                break
+            if buf[pos] == ',' and self.count:
+                pos += 1
+                continue
+            try:
+                element, end = self._decoder.raw_decode(buf, pos)
+            except ValueError:
+                self._stalled = True
+                break
+            delimiter = end
+            while delimiter < len(buf) and buf[delimiter] in _WHITESPACE:
+                delimiter += 1
+            if delimiter == len(buf) or buf[delimiter] not in ',]':
+                # a number may continue in the next chunk, e.g. "-4." then
+                # "5e6": the element is complete once a delimiter follows
+                self._stalled = True
+                break
+            self._stalled = False
+            pos = end
+            self.count += 1
+            self.callback(element)
+        self._buffer = buf[pos:]
+
+    def close(self):
+        """Finish parsing, raise ValueError if the array was truncated"""
+        self._buffer += self._text.decode(b'', final=True)
+        if not self._done:
+            self._stalled = False
+            self._parse()
+        if not self._done or self._buffer.strip():
+            raise ValueError("Truncated or malformed JSON array")
@@ -0,0 +1,136 @@
+"""Minimal in-process metrics registry: counters, gauges and histograms"""
+
+import threading
+from collections import OrderedDict
+
+# default latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in pairs)
+
+
+class Counter(object):
+    """Monotonically increasing value"""
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge(object):
+    """Value that can go up and down"""
+    kind = 'gauge'
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Histogram(object):
+    """Distribution of observed values over fixed buckets"""
+    kind = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+
+
+class Family(object):
+    """All children of one metric name, keyed by their label values"""
+
+    def __init__(self, cls, name, doc, **kwargs):
+        self.cls = cls
+        self.name = name
+        self.doc = doc
+        self.kwargs = kwargs
+        self.children = OrderedDict()
+
+    def labels(self, **labels):
+        key = tuple(sorted(labels.items()))
+        child = self.children.get(key)
+        if child is None:
+            child = self.children.setdefault(key, self.cls(**self.kwargs))
+        return child
+
+
+class Registry(object):
+    """Collection of metric families, shared by the whole process"""
+
+    def __init__(self):
+        self.families = OrderedDict()
+
+    def _get(self, cls, name, doc, labels, **kwargs):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families.setdefault(
+                name, Family(cls, name, doc, **kwargs))
+        return family.labels(**labels)
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        for family in list(self.families.values()):
+            lines.append('# HELP %s %s' % (family.name, family.doc))
+            lines.append('# TYPE %s %s' % (family.name, family.cls.kind))
+            for labels, child in list(family.children.items()):
+                if family.cls is Histogram:
+                    for bound, count in zip(child.buckets, child.counts):
+                        lines.append('%s_bucket%s %s' % (
+                            family.name,
+                            _format_labels(labels, [('le', repr(float(bound)))]),
+                            count))
+                    lines.append('%s_bucket%s %s' % (
+                        family.name, _format_labels(labels, [('le', '+Inf')]),
+                        child.count))
+                    lines.append('%s_sum%s %r' % (
+                        family.name, _format_labels(labels), child.sum))
+                    lines.append('%s_count%s %s' % (
+                        family.name, _format_labels(labels), child.count))
+                else:
+                    lines.append('%s%s %r' % (
+                        family.name, _format_labels(labels), child.value))
+        return '\n'.join(lines) + '\n'
+
+    def counter(self, name, doc='', **labels):
+        return self._get(Counter, name, doc, labels)
+
+    def gauge(self, name, doc='', **labels):
+        return self._get(Gauge, name, doc, labels)
+
+    def histogram(self, name, doc='', buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, doc, labels, buckets=buckets)
+
+
+REGISTRY = Registry()
@@ -0,0 +1,26 @@
+"""Notification plugins, selected by the 'notifier' config option"""
+
+import importlib
+
+NOTIFIERS = {
+    'pushover': 'notifiers.pushover_notifier.PushoverNotifier',
+    'email': 'notifiers.email_notifier.EmailNotifier',
+    'osx': 'notifiers.osx_notifier.OSXNotifier',
+    'popup': 'notifiers.popup_notifier.PopupNotifier',
+    'popup_pywin': 'notifiers.popup_pywin_notifier.PopupPywinNotifier',
+    'smsapi': 'notifiers.smsapi_notifier.SmsApiNotifier',
+    'xmpp': 'notifiers.xmpp_notifier.XMPPNotifier',
+    'pushbullet': 'notifiers.pushbullet_notifier.PushbulletNotifier',
+    'file': 'notifiers.file_notifier.FileNotifier',
+    'freemobile': 'notifiers.freemobile_notifier.FreemobileNotifier',
+    'telegram': 'notifiers.telegram_notifier.TelegramNotifier',
+    'multi': 'notifiers.multi_notifier.MultiNotifier',
+}
+
+
+def load_notifier(config):
+    """Instantiate the notifier class selected in config, 'email' by default"""
+    path = NOTIFIERS[config.get('notifier', 'email')]
+    module_name, class_name = path.rsplit('.', 1)
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)(config)
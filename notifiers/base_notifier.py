@@ -1,14 +1,52 @@
 """Generic notifier, to be subclassed"""
 
+import json
 import logging
+from tornado.httpclient import AsyncHTTPClient, HTTPClient
+# Python 3 imports
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
 _logger = logging.getLogger(__name__)
 
 
+def combine_messages(messages):
+    """Merge several notification messages into a single one"""
+    if len(messages) == 1:
+        return dict(messages[0])
+    urls = []
+    for message in messages:
+        url = message.get('url')
+        if url and url not in urls:
+            urls.append(url)
+    if len(urls) > 1:
+        lines = ['%s - %s' % (m['text'], m['url']) if m.get('url')
+                 else m['text'] for m in messages]
+    else:
+        lines = [m['text'] for m in messages]
+    return {
+        'title': "%d servers are available" % len(messages),
+        'text': '\n'.join(lines),
+        'url': urls[0] if urls else None,
+    }
+
+
 class Notifier(object):
     """Abstract class for notifiers"""
+    # blocking notifiers are run in a thread pool by the dispatcher,
+    # non-blocking ones must return a future from notify()
+    blocking = True
+
     def __init__(self, config):
-        """Save config and run system check"""
+        """Save config and run system check, unless fast_start defers it"""
         self.config = config
+        if not config.get('fast_start'):
+            self.validate()
+
+    def validate(self):
+        """Run system check, may block on network logins"""
         self.check_requirements()
         _logger.info("Notification system check passed")
 
@@ -19,3 +57,61 @@ class Notifier(object):
     def notify(self, title, text, url=None):
         """Abstract method for notification sending"""
         raise NotImplementedError
+
+    def notify_many(self, messages):
+        """Send a batch of messages as one notification, override to
+        use a channel-specific batch format"""
+        return self.notify(**combine_messages(messages))
+
+    def close(self):
+        """Release connections held by the notifier, called on shutdown"""
+        pass
+
+
+class AsyncNotifier(Notifier):
+    """Abstract class for notifiers talking to an HTTP API.
+
+    notify() must return a future: requests go through the AsyncHTTPClient
+    shared with the crawler on its IOLoop, reusing its connection pool.
+    check_requirements() runs before the IOLoop, or in a worker thread,
+    so it uses the blocking fetch_sync()."""
+    blocking = False
+    request_timeout = 20
+
+    def fetch(self, url, params=None, body=None, json_body=None, **kwargs):
+        """Request url on the shared client, return a future"""
+        return AsyncHTTPClient().fetch(
+            self._request_url(url, params), request_timeout=self.request_timeout,
+            **self._request_body(body, json_body, kwargs))
+
+    def fetch_sync(self, url, params=None, body=None, json_body=None,
+                   **kwargs):
+        """Request url and wait for the response"""
+        client = HTTPClient()
+        try:
+            return client.fetch(
+                self._request_url(url, params),
+                request_timeout=self.request_timeout,
+                **self._request_body(body, json_body, kwargs))
+        finally:
+            client.close()
+
+    @staticmethod
+    def _request_url(url, params):
+        if params:
+            url += ('&' if '?' in url else '?') + urlencode(params)
+        return url
+
+    @staticmethod
+    def _request_body(body, json_body, kwargs):
+        headers = dict(kwargs.pop('headers', None) or {})
+        if json_body is not None:
+            body = json.dumps(json_body)
+            headers['Content-Type'] = 'application/json'
+        elif isinstance(body, dict):
+            body = urlencode(body)
+        if body is not None:
+            kwargs.setdefault('method', 'POST')
+            kwargs['body'] = body
+        kwargs['headers'] = headers
+        return kwargs
@@ -1,8 +1,11 @@
 """Notifier that sends email messages through SMTP"""
 
 import sys
+import time
+import socket
 import logging
 import smtplib
+import threading
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from notifiers.base_notifier import Notifier
@@ -29,10 +32,15 @@ class EmailNotifier(Notifier):
                                465 if self.use_ssl else 587)
         self.toaddr = config['to_email']
         self.login_required = self.fromuser and config['from_pwd']
+        # idle seconds after which the session is checked with NOOP
+        self.keepalive = config.get('smtp_keepalive', 60)
+        self.server = None
+        self.last_used = 0
+        self.lock = threading.Lock()
         super(EmailNotifier, self).__init__(config)
 
-    def check_requirements(self):
-        """Logs in to SMTP server to check credentials and settings"""
+    def _connect(self):
+        """Open a new SMTP session, negotiate TLS and log in"""
         if self.use_ssl:
             server = smtplib.SMTP_SSL(self.host, self.port)
         else:
@@ -41,33 +49,65 @@ class EmailNotifier(Notifier):
         if self.use_starttls:
             server.starttls()
             server.ehlo()
+        if self.login_required:
+            server.login(self.fromuser, self.frompwd)
+        return server
+
+    def _get_server(self):
+        """Return the open SMTP session, reconnecting if it went stale"""
+        if self.server is not None and \
+                time.time() - self.last_used > self.keepalive:
+            try:
+                if self.server.noop()[0] != 250:
+                    raise smtplib.SMTPException("NOOP rejected")
+            except (smtplib.SMTPException, socket.error) as ex:
+                _logger.info("SMTP connection lost (%s), reconnecting", ex)
+                self._drop_server()
+        if self.server is None:
+            self.server = self._connect()
+        return self.server
+
+    def _drop_server(self):
+        server, self.server = self.server, None
+        if server is None:
+            return
         try:
-            if self.login_required:
-                server.login(self.fromuser, self.frompwd)
+            server.quit()
+        except (smtplib.SMTPException, socket.error):
+            server.close()
+
+    def check_requirements(self):
+        """Logs in to SMTP server to check credentials and settings"""
+        try:
+            self.server = self._connect()
         except Exception as ex:
             _logger.error("Cannot connect to your SMTP account. "
                           "Correct your config and try again. Error details:")
             _logger.error(ex)
             raise
+        self.last_used = time.time()
         _logger.info("SMTP server check passed")
 
     def notify(self, title, text, url=None):
-        """Send email notification using SMTP"""
+        """Send email notification over the persistent SMTP session"""
         msg = MIMEMultipart()
         msg['From'] = self.fromaddr
         msg['To'] = self.toaddr
         msg['Subject'] = title
-        body = text if url else text + '\nURL: ' + url
+        body = text + '\nURL: ' + url if url else text
         msg.attach(MIMEText(body, 'plain'))
-        if self.use_ssl:
-            server = smtplib.SMTP_SSL(self.host, self.port)
-        else:
-            server = smtplib.SMTP(self.host, self.port)
-        server.ehlo()
-        if self.use_starttls:
-            server.starttls()
-            server.ehlo()
-        if self.login_required:
-          server.login(self.fromuser, self.frompwd)
         text = msg.as_string()
-        server.sendmail(self.fromaddr, self.toaddr, text)
+        with self.lock:
+            try:
+                self._get_server().sendmail(self.fromaddr, self.toaddr, text)
+            except (smtplib.SMTPServerDisconnected, socket.error) as ex:
+                # session died between health check and send, retry once
+                _logger.info("SMTP connection lost (%s), reconnecting", ex)
+                self._drop_server()
+                self._get_server().sendmail(self.fromaddr, self.toaddr, text)
+            self.last_used = time.time()
+
+    def close(self):
+        """Quit the SMTP session"""
+        with self.lock:
+            self._drop_server()
@@ -11,26 +11,45 @@ import os
 import datetime
 import logging
 from notifiers.base_notifier import Notifier
+# Python 3 imports
+try:
+    from html import escape
+except ImportError:
+    from cgi import escape
 
 _logger = logging.getLogger(__name__)
 
+
 class FileNotifier(Notifier):
-    """Notifier class to work with file"""
+    """Notifier class to work with file, keeping the latest notifications
+    first, one per line"""
 
     def __init__(self, config):
         self.file_path = config.get('file_path')
+        self.max_entries = config.get('file_max_entries', 50)
         super(FileNotifier, self).__init__(config)
 
     def check_requirements(self):
-        """Check if file exist"""
+        """Check that file_path is set, create the file if needed"""
+        if not self.file_path:
+            raise Warning("'file_path' is required by the file notifier")
         if not os.path.isfile(self.file_path):
-            _logger.error("File not found")
-            _logger.error(ex)
-            raise
+            _logger.info("Creating %s", self.file_path)
+            open(self.file_path, 'a').close()
         _logger.info("File notifier check passed")
 
     def notify(self, title, text, url=None):
-        """Update html file"""
-        with open(self.file_path, "a") as file:
-            ts = '{:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now())
-            file.write('<br/>AVAILABLE! - %s' % ts)
\ No newline at end of file
+        """Prepend a line to the html file, dropping the oldest ones"""
+        ts = '{:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now())
+        title = escape(title)
+        if url:
+            title = '<a href="%s">%s</a>' % (escape(url, quote=True), title)
+        line = '<p>AVAILABLE! - %s - %s: %s</p>\n' % (ts, title, escape(text))
+        with open(self.file_path, 'r') as html_file:
+            lines = html_file.readlines()
+        lines = [line] + lines[:self.max_entries - 1]
+        # replace the file at once, so readers never see it half written
+        tmp_path = self.file_path + '.tmp'
+        with open(tmp_path, 'w') as html_file:
+            html_file.writelines(lines)
+        os.rename(tmp_path, self.file_path)
@@ -1,15 +1,16 @@
 """Notifier that sends sms to freemobile client using FM notifications API"""
 
 import logging
-import webbrowser
-from notifiers.base_notifier import Notifier
+from notifiers.base_notifier import AsyncNotifier
 
 _logger = logging.getLogger(__name__)
 
 
-class FreemobileNotifier(Notifier):
+class FreemobileNotifier(AsyncNotifier):
     """Notifier class for freemobile sms"""
 
+    API_URL = "https://smsapi.free-mobile.fr/sendmsg"
+
     def __init__(self, config):
         self.username = config.get('freemobile_username', '')
         self.password = config.get('freemobile_key', '')
@@ -17,16 +18,16 @@ class FreemobileNotifier(Notifier):
         super(FreemobileNotifier, self).__init__(config)
 
     def check_requirements(self):
-        """Check requests library is installed"""
-        try:
-            __import__('requests')
-        except ImportError:
+        """Check freemobile credentials are set"""
+        if not self.username or not self.password:
             raise Warning(
-                "requests Python library is required for freemobile notifications. ")
+                "freemobile_username and freemobile_key are required "
+                "for freemobile notifications.")
 
     def notify(self, title, text, url=False):
-        """"""
-        import requests
-
-        requests.get("https://smsapi.free-mobile.fr/sendmsg?user={user}&pass={key}&msg={msg}"
-            .format(user=self.username, key=self.password, msg='Kimsufi: '+text))
+        """Send sms through the freemobile API"""
+        return self.fetch(self.API_URL, params={
+            'user': self.username,
+            'pass': self.password,
+            'msg': 'Kimsufi: ' + text,
+        })
@@ -0,0 +1,276 @@
+"""Notifier sending alerts to several channels at once, with fallback and
+escalation routes, and a circuit breaker per channel"""
+
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.ioloop import IOLoop
+from metrics import REGISTRY
+from notifiers.base_notifier import Notifier
+
+_logger = logging.getLogger(__name__)
+
+ROUTES = ('primary', 'fallback', 'escalation')
+
+
+class CircuitBreaker(object):
+    """Skip a failing channel instead of waiting for its timeout.
+
+    After threshold consecutive failures the circuit opens, and calls are
+    refused for reset_timeout seconds. Then one call is let through: its
+    success closes the circuit, its failure opens it again."""
+
+    def __init__(self, threshold=3, reset_timeout=60, name=''):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None      # time the circuit opened, None if closed
+        self.trial = False      # a call is let through while open
+        self.gauge = REGISTRY.gauge(
+            'notification_channel_open',
+            'Channels skipped by their circuit breaker', channel=name)
+
+    def allow(self):
+        if self.opened is None:
+            return True
+        if not self.trial and time.time() - self.opened >= self.reset_timeout:
+            self.trial = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.gauge.set(0)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial or self.failures >= self.threshold:
+            self.trip()
+
+    def trip(self):
+        """Open the circuit now"""
+        self.opened = time.time()
+        self.trial = False
+        self.gauge.set(1)
+
+
+class Channel(object):
+    """Notifier of one channel, and how alerts are routed to it"""
+
+    def __init__(self, name, notifier, route='primary', escalate_after=300,
+                 breaker=None):
+        if route not in ROUTES:
+            raise ValueError("Unknown route %r of channel %s, use one of %s"
+                             % (route, name, ', '.join(ROUTES)))
+        self.name = name
+        self.notifier = notifier
+        self.route = route
+        self.escalate_after = escalate_after
+        self.breaker = breaker or CircuitBreaker(name=name)
+        self.failures = REGISTRY.counter(
+            'notification_channel_failures_total',
+            'Failed deliveries to a channel', channel=name)
+        self.skipped = REGISTRY.counter(
+            'notification_channel_skipped_total',
+            'Deliveries skipped while the channel circuit was open',
+            channel=name)
+
+
+class MultiNotifier(Notifier):
+    """Send every alert to all primary channels concurrently. Fallback
+    channels are used only when no primary channel delivered it.
+    Escalation channels get it after their escalate_after seconds, unless
+    it was acknowledged on the ack_url link appended to alerts, or at
+    once if no other channel delivered it.
+
+    Alerts are identified by the key of their transitions given by the
+    dispatcher, unique to the subscription and availability episode, or
+    by their subscription and content otherwise. Retries of an alert no
+    channel delivered escalate only once within escalation_window
+    seconds.
+
+    Channels are configured like subscriptions, each inheriting the
+    settings of its parent. A channel failing its system check starts
+    with an open circuit; the check fails only if no primary or fallback
+    channel passed it."""
+    blocking = False
+    # alert id -> escalation timeouts, shared by every multi notifier
+    pending = {}
+
+    def __init__(self, config):
+        parent = dict((key, value) for key, value in config.items()
+                      if key != 'channels')
+        self.channels = []
+        for i, definition in enumerate(config.get('channels', [])):
+            self.channels.append(self.load_channel(
+                definition.get('name') or '%s-%s' % (
+                    definition.get('notifier', 'email'), i + 1),
+                dict(parent, **definition)))
+        self.timeout = config.get('channel_timeout', 10)
+        self.ack_url = config.get('ack_url')
+        self.escalation_window = config.get('escalation_window', 3600)
+        self.name = config.get('name', 'default')
+        # alert id -> time it was escalated at once, none delivering it
+        self.escalated = {}
+        self.executor = ThreadPoolExecutor(max_workers=max(1, sum(
+            1 for channel in self.channels if channel.notifier.blocking)))
+        self.escalations = REGISTRY.counter(
+            'notification_escalations_total',
+            'Alerts sent to escalation channels')
+        super(MultiNotifier, self).__init__(config)
+
+    @staticmethod
+    def load_channel(name, config):
+        from notifiers import load_notifier
+        # channels are checked by the multi notifier, failures tolerated
+        notifier = load_notifier(dict(config, fast_start=True))
+        return Channel(name, notifier, config.get('route', 'primary'),
+                       config.get('escalate_after', 300),
+                       CircuitBreaker(config.get('circuit_threshold', 3),
+                                      config.get('circuit_reset', 60), name))
+
+    def routed(self, route):
+        return [channel for channel in self.channels if channel.route == route]
+
+    def check_requirements(self):
+        """Check every channel, fail if none can deliver alerts"""
+        if not self.routed('primary'):
+            raise Warning("At least one primary channel is required by the "
+                          "multi notifier in 'channels'")
+        passed = []
+        for channel in self.channels:
+            try:
+                channel.notifier.validate()
+            except Exception as ex:
+                _logger.error("Channel %s check failed, it is skipped until "
+                              "it recovers: %s", channel.name, ex)
+                channel.breaker.trip()
+            else:
+                passed.append(channel)
+        if not [channel for channel in passed if channel.route != 'escalation']:
+            raise Warning("No primary or fallback channel passed its check")
+
+    def notify(self, title, text, url=None):
+        return self.send([{'title': title, 'text': text, 'url': url}])
+
+    def notify_many(self, messages):
+        return self.send(messages)
+
+    def notify_alert(self, messages, key):
+        """Send messages of the alert identified by key"""
+        return self.send(messages, key)
+
+    async def send(self, messages, key=None):
+        """Deliver to primary channels, then fallback ones if none did,
+        and schedule escalation. Raise if no channel delivered"""
+        escalation = self.routed('escalation')
+        alert_id = hashlib.sha1(json.dumps(
+            [self.name, key or messages], sort_keys=True)
+            .encode('utf-8')).hexdigest()[:12]
+        sent = messages
+        if escalation and self.ack_url:
+            sent = [dict(m) for m in messages]
+            sent[-1]['text'] += "\nAcknowledge: %s/%s" % (
+                self.ack_url.rstrip('/'), alert_id)
+        delivered = await self.fan_out(self.routed('primary'), sent)
+        if not delivered and self.routed('fallback'):
+            _logger.warning("No primary channel delivered the alert, "
+                            "using fallback channels")
+            delivered = await self.fan_out(self.routed('fallback'), sent)
+        if escalation and not self.is_scheduled(alert_id):
+            self.escalate_later(alert_id, escalation, messages,
+                                immediately=not delivered)
+        if not delivered:
+            raise RuntimeError("No channel delivered the notification")
+
+    def is_scheduled(self, alert_id):
+        """Return True if the escalation of an alert is pending, or was
+        done at once by a previous attempt to deliver it"""
+        now = time.time()
+        for known, escalated in list(self.escalated.items()):
+            if now - escalated >= self.escalation_window:
+                del self.escalated[known]
+        return alert_id in MultiNotifier.pending or alert_id in self.escalated
+
+    def escalate_later(self, alert_id, channels, messages, immediately=False):
+        if immediately:
+            # retries of the delivery must not escalate again
+            self.escalated[alert_id] = time.time()
+        by_delay = {}
+        for channel in channels:
+            delay = 0 if immediately else channel.escalate_after
+            by_delay.setdefault(delay, []).append(channel)
+        # in firing order, each escalation drops the first timeout
+        MultiNotifier.pending[alert_id] = [
+            IOLoop.current().call_later(delay, self.escalate, alert_id,
+                                        delayed, messages, delay)
+            for delay, delayed in sorted(by_delay.items())]
+
+    async def escalate(self, alert_id, channels, messages, delay):
+        timeouts = MultiNotifier.pending.get(alert_id, [])
+        if len(timeouts) <= 1:
+            MultiNotifier.pending.pop(alert_id, None)
+        else:
+            timeouts.pop(0)
+        self.escalations.inc()
+        _logger.warning("Alert %s not acknowledged after %ss, escalating to "
+                        "%s", alert_id, delay,
+                        ', '.join(channel.name for channel in channels))
+        messages = [dict(m, text="Not acknowledged after %ss: %s" % (
+            delay, m['text'])) for m in messages]
+        delivered = await self.fan_out(channels, messages)
+        if not delivered:
+            _logger.error("Escalation of alert %s failed", alert_id)
+
+    @classmethod
+    def acknowledge(cls, alert_id):
+        """Cancel the escalation of an alert, return False if unknown"""
+        timeouts = cls.pending.pop(alert_id, None)
+        if timeouts is None:
+            return False
+        for timeout in timeouts:
+            IOLoop.current().remove_timeout(timeout)
+        _logger.info("Alert %s acknowledged", alert_id)
+        return True
+
+    async def fan_out(self, channels, messages):
+        """Deliver to channels concurrently, return how many delivered"""
+        results = await asyncio.gather(*[self.deliver(channel, messages)
+                                         for channel in channels])
+        return sum(results)
+
+    async def deliver(self, channel, messages):
+        if not channel.breaker.allow():
+            channel.skipped.inc()
+            return False
+        try:
+            await gen.with_timeout(datetime.timedelta(seconds=self.timeout),
+                                   self.call(channel.notifier, messages))
+        except Exception as ex:
+            channel.failures.inc()
+            channel.breaker.record_failure()
+            _logger.error("Channel %s failed: %s", channel.name, ex)
+            return False
+        channel.breaker.record_success()
+        return True
+
+    def call(self, notifier, messages):
+        if len(messages) == 1:
+            func, args, kwargs = notifier.notify, (), messages[0]
+        else:
+            func, args, kwargs = notifier.notify_many, (messages,), {}
+        if notifier.blocking:
+            return self.executor.submit(func, *args, **kwargs)
+        return func(*args, **kwargs)
+
+    def close(self):
+        for channel in self.channels:
+            channel.notifier.close()
+        self.executor.shutdown(wait=False)
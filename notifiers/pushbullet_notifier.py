@@ -1,15 +1,16 @@
 """Notifier that sends messages through Pushbullet"""
 
 import logging
-from pushbullet import Pushbullet
-from notifiers.base_notifier import Notifier
+from notifiers.base_notifier import AsyncNotifier
 
 _logger = logging.getLogger(__name__)
 
 
-class PushbulletNotifier(Notifier):
+class PushbulletNotifier(AsyncNotifier):
     """Notifier class to work with Pushbullet"""
 
+    API_URL = "https://api.pushbullet.com/v2/"
+
     def __init__(self, config):
         """Override init to check settings"""
         self.pushbullet_apikey = config['pushbullet_apikey']
@@ -17,7 +18,8 @@ class PushbulletNotifier(Notifier):
 
     def check_requirements(self):
         try:
-            pb = Pushbullet(self.pushbullet_apikey)
+            self.fetch_sync(self.API_URL + 'users/me',
+                            headers={'Access-Token': self.pushbullet_apikey})
         except Exception as ex:
             _logger.error("Cannot connect to your Pushbullet account. "
                           "Correct your config and try again. Error details:")
@@ -26,5 +28,10 @@ class PushbulletNotifier(Notifier):
         _logger.info("Pushbullet server check passed")
 
     def notify(self, title, text, url=None):
-        pb = Pushbullet(self.pushbullet_apikey)
-        push = pb.push_link(text, url)
\ No newline at end of file
+        push = {'type': 'link', 'title': title, 'body': text}
+        if url:
+            push['url'] = url
+        else:
+            push['type'] = 'note'
+        return self.fetch(self.API_URL + 'pushes', json_body=push,
+                          headers={'Access-Token': self.pushbullet_apikey})
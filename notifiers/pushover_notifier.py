@@ -1,15 +1,17 @@
 """Notifier that sends messages through Pushover"""
 
+import json
 import logging
-from chump import Application
-from notifiers.base_notifier import Notifier
+from notifiers.base_notifier import AsyncNotifier
 
 _logger = logging.getLogger(__name__)
 
 
-class PushoverNotifier(Notifier):
+class PushoverNotifier(AsyncNotifier):
     """Notifier class to work with Pushover"""
 
+    API_URL = "https://api.pushover.net/1/"
+
     def __init__(self, config):
         """Override init to make Pushover-settings check"""
         self.application_id = config.get('pushover_application_id')
@@ -18,11 +20,12 @@ class PushoverNotifier(Notifier):
         super(PushoverNotifier, self).__init__(config)
 
     def check_requirements(self):
-        app = Application(self.application_id)
-
         try:
-            user = app.get_user(self.user_id)
-            if not user.is_authenticated:
+            resp = self.fetch_sync(self.API_URL + 'users/validate.json', body={
+                'token': self.application_id,
+                'user': self.user_id,
+            })
+            if json.loads(resp.body.decode('utf-8')).get('status') != 1:
                 raise ValueError("User could not be authenticated")
         except Exception as ex:
             _logger.error("Cannot connect to your Pushover account. "
@@ -32,10 +35,13 @@ class PushoverNotifier(Notifier):
         _logger.info("Pushover server check passed")
 
     def notify(self, title, text, url=None):
-        app = Application(self.application_id)
-        user = app.get_user(self.user_id)
-
-        message = user.send_message(message=text,
-                                    title=title,
-                                    url=url,
-                                    priority=self.priority)
+        message = {
+            'token': self.application_id,
+            'user': self.user_id,
+            'title': title,
+            'message': text,
+            'priority': self.priority,
+        }
+        if url:
+            message['url'] = url
+        return self.fetch(self.API_URL + 'messages.json', body=message)
@@ -1,30 +1,49 @@
 """Notifier that sends messages through smsapi.pl, Polish SMS service"""
 
+import json
+import hashlib
 import logging
-
-from notifiers.base_notifier import Notifier
-from smsapi import SmsApi
+from tornado.gen import coroutine
+from notifiers.base_notifier import AsyncNotifier
 
 
 _logger = logging.getLogger(__name__)
 
 
-class SmsApiNotifier(Notifier):
-    """Notifier class to work with email"""
+class SmsApiNotifier(AsyncNotifier):
+    """Notifier class to work with smsapi.pl"""
+
+    API_URL = "https://api.smsapi.pl/"
 
     def __init__(self, config):
         """Override init to check settings"""
         self.smsapi_username = config['smsapi_username']
-        self.smsapi_password = config['smsapi_password']
+        # the API expects the MD5 hash of the password
+        self.smsapi_password = hashlib.md5(
+            config['smsapi_password'].encode('utf-8')).hexdigest()
         self.smsapi_recipient = config['smsapi_recipient']
 
         super(SmsApiNotifier, self).__init__(config)
 
+    def _params(self, **params):
+        params.update(username=self.smsapi_username,
+                      password=self.smsapi_password, format='json')
+        return params
+
+    @staticmethod
+    def _result(resp):
+        result = json.loads(resp.body.decode('utf-8'))
+        if 'error' in result:
+            raise Exception("SMSAPI error %s: %s" % (
+                result['error'], result.get('message')))
+        return result
+
     def check_requirements(self):
         """Log in to smsapi and check credentials and settings"""
-        sms = SmsApi(self.smsapi_username, self.smsapi_password)
         try:
-            total_points = sms.get_points()['points']
+            resp = self.fetch_sync(self.API_URL + 'user.do',
+                                   params=self._params(credits=1, details=1))
+            total_points = self._result(resp)['points']
         except Exception as ex:
             _logger.error("Cannot connect to your SMSAPI account. "
                           "Correct your config and try again. Error details:")
@@ -32,9 +51,11 @@ class SmsApiNotifier(Notifier):
             raise
         _logger.info("SMSAPI connected. You have %s points." % total_points)
 
+    @coroutine
     def notify(self, title, text, url=False):
         """Send sms notification using smsapi.pl"""
         body = text + ' - ' + url
-        sms = SmsApi(self.smsapi_username, self.smsapi_password)
-        sms.send_sms(body, recipient=self.smsapi_recipient)
+        resp = yield self.fetch(self.API_URL + 'sms.do', body=self._params(
+            to=self.smsapi_recipient, message=body))
+        self._result(resp)
         _logger.info("SMSAPI sent: [%s] %s" % (self.smsapi_recipient, body))
@@ -1,33 +1,34 @@
 """Notifier that sends a message to the specified chat through Telegram"""
 
 import logging
-from notifiers.base_notifier import Notifier
-import telegram
-from telegram.error import TelegramError
+from notifiers.base_notifier import AsyncNotifier
 
 _logger = logging.getLogger(__name__)
 
 
-class TelegramNotifier(Notifier):
+class TelegramNotifier(AsyncNotifier):
     """Notifier class for Telegram"""
 
+    API_URL = "https://api.telegram.org/bot{token}/{method}"
+
     def __init__(self, config):
         self.chat_id = config.get('telegram_chat_id')
-        token = config.get('telegram_token')
-        self.bot = telegram.Bot(token=token)
+        self.token = config.get('telegram_token')
         super().__init__(config)
 
+    def _method_url(self, method):
+        return self.API_URL.format(token=self.token, method=method)
+
     def check_requirements(self):
         try:
-            self.bot.get_me()
-            self.bot.send_message(chat_id=self.chat_id, text="Kimsufi Crawler started")
-        except TelegramError as te:
-            _logger.error("Telegram validation failed: {error}".format(error=te.message))
+            self.fetch_sync(self._method_url('getMe'))
+            self.fetch_sync(self._method_url('sendMessage'), json_body={
+                'chat_id': self.chat_id, 'text': "Kimsufi Crawler started"})
+        except Exception as ex:
+            _logger.error("Telegram validation failed: {error}".format(error=ex))
             raise
 
     def notify(self, title, text, url=None):
-        try:
-            self.bot.send_message(chat_id=self.chat_id, text=text)
-        except TelegramError as te:
-            _logger.error("Something went wrong sending the message to Telegram:")
-            _logger.error(te)
+        """Send message, errors are raised so that delivery is retried"""
+        return self.fetch(self._method_url('sendMessage'), json_body={
+            'chat_id': self.chat_id, 'text': text})
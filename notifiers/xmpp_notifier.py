@@ -1,6 +1,8 @@
 """Notifier that sends messages through XMPP/JABBER"""
 
+import time
 import logging
+import threading
 
 from notifiers.base_notifier import Notifier
 import xmpp
@@ -21,18 +23,55 @@ class XMPPNotifier(Notifier):
         else:
             self.xmpp_recipient = config['xmpp_recipient']
         self.xmpp_send_test = config.get('xmpp_send_test', False)
+        # idle seconds after which the session is pinged before use
+        self.keepalive = config.get('xmpp_keepalive', 60)
+        self.client = None
+        self.last_used = 0
+        self.lock = threading.Lock()
         super(XMPPNotifier, self).__init__(config)
 
+    def _connect(self):
+        """Open a new XMPP session and authenticate"""
+        jid = xmpp.protocol.JID(self.xmpp_jid)
+        cl = xmpp.Client(jid.getDomain(),debug=[])
+        if not cl.connect():
+            raise Exception("Connect failed.")
+
+        if not cl.auth(jid.getNode(), self.xmpp_password, resource=jid.getResource()):
+            raise Exception("Authentication failed.")
+        return cl
+
+    def _get_client(self):
+        """Return the open XMPP session, reconnecting if it went stale"""
+        if self.client is not None:
+            healthy = self.client.isConnected()
+            if healthy and time.time() - self.last_used > self.keepalive:
+                # whitespace ping, raises or disconnects if the stream was
+                # closed; raw strings return nothing to check
+                try:
+                    self.client.send(' ')
+                    healthy = self.client.isConnected()
+                except Exception:
+                    healthy = False
+            if not healthy:
+                _logger.info("XMPP connection lost, reconnecting")
+                self._drop_client()
+        if self.client is None:
+            self.client = self._connect()
+        return self.client
+
+    def _drop_client(self):
+        client, self.client = self.client, None
+        if client is not None:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+
     def check_requirements(self):
         """Log in to xmpp server and check credentials"""
-        jid = xmpp.protocol.JID(self.xmpp_jid)
         try:
-            cl = xmpp.Client(jid.getDomain(),debug=[])
-            if not cl.connect():
-                raise Exception("Connect failed.")
-
-            if not cl.auth(jid.getNode(), self.xmpp_password, resource=jid.getResource()):
-                raise Exception("Authentication failed.")
+            self.client = cl = self._connect()
 
             if self.xmpp_send_test:
                 for recipient in self.xmpp_recipient:
@@ -45,21 +84,28 @@ class XMPPNotifier(Notifier):
                           "Correct your config and try again. Error details:")
             _logger.error(ex)
             raise
+        self.last_used = time.time()
         _logger.info("XMPP connected.")
 
     def notify(self, title, text, url=False):
-        """Send XMPP notification"""
+        """Send XMPP notification over the persistent session, errors are
+        raised so that delivery is retried"""
         body = text + ' - ' + url
-        jid = xmpp.protocol.JID(self.xmpp_jid)
-        cl = xmpp.Client(jid.getDomain(),debug=[])
-        if not cl.connect():
-            raise Exception("Connect failed.")
-
-        if not cl.auth(jid.getNode(), self.xmpp_password, resource=jid.getResource()):
-            raise Exception("Authentication failed.")
-
-        for recipient in self.xmpp_recipient:
-            if not cl.send(xmpp.protocol.Message(recipient, body)):
-                _logger.error("Failed to send message to %s" % (recipient, ))
-            else:
+        with self.lock:
+            cl = self._get_client()
+            for recipient in self.xmpp_recipient:
+                try:
+                    sent = cl.send(xmpp.protocol.Message(recipient, body))
+                except Exception:
+                    sent = False
+                if not sent:
+                    # reconnect on the next attempt
+                    self._drop_client()
+                    raise Exception("Failed to send message to %s" % (recipient, ))
                 _logger.info("XMPP sent: [%s] %s" % (recipient, body))
+            self.last_used = time.time()
+
+    def close(self):
+        """Disconnect the XMPP session"""
+        with self.lock:
+            self._drop_client()
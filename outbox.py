@@ -0,0 +1,269 @@
+"""Durable outbox: notifications are stored in SQLite before delivery and
+kept until a notifier accepted them, so alerts survive notifier outages
+and crawler restarts"""
+
+import json
+import time
+import uuid
+import random
+import sqlite3
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from tornado.gen import coroutine, sleep, Return
+from tornado.ioloop import IOLoop
+from metrics import REGISTRY
+
+_logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    subscription TEXT NOT NULL,
+    messages TEXT NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    delivered REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (delivered, next_attempt);
+CREATE INDEX IF NOT EXISTS outbox_key ON outbox (key, created);
+CREATE TABLE IF NOT EXISTS outbox_alerts (
+    subscription TEXT NOT NULL,
+    state TEXT NOT NULL,
+    episode REAL NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_alerts_state
+    ON outbox_alerts (subscription, state, created);
+"""
+
+
+def idempotency_key(subscription, transitions):
+    """Same (state, episode start) transitions to the same subscription,
+    same key. A state becoming available again is a new transition"""
+    return hashlib.sha1(json.dumps([subscription, sorted(transitions)])
+                        .encode('utf-8')).hexdigest()
+
+
+class Outbox(object):
+    """At-least-once delivery of notifications.
+
+    Batches are written before being queued by their dispatcher, and
+    leased while queued. Rows are marked delivered once a notifier
+    accepted them; failed ones are retried with exponential backoff by a
+    worker taking due rows as queues have room, which also delivers rows
+    left pending by a previous run.
+
+    Every alert is stored with its state and the start of its availability
+    episode. An alert of a state found available in the first payload
+    after a restart, i.e. of an unknown episode, is dropped if the same
+    subscription stored one within dedup_window seconds: it was detected
+    again after a crash. A server restocked again is a new episode and
+    notified. Rows are marked delivered before the next one is taken.
+    All database access runs in one background thread."""
+
+    def __init__(self, filename, poll_interval=1, backoff=30,
+                 max_backoff=3600, dedup_window=60, retention=86400):
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.dedup_window = dedup_window
+        self.retention = retention
+        self.lease = max_backoff    # queued rows are not due before
+        self.dispatchers = {}   # subscription name -> dispatcher
+        self.running = False
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.pending = REGISTRY.gauge(
+            'notification_outbox_pending',
+            'Notifications stored and not delivered yet')
+        self.retries = REGISTRY.counter(
+            'notification_outbox_retries_total',
+            'Notifications queued again from the outbox')
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['outbox_file'],
+                   backoff=config.get('outbox_retry_backoff', 30),
+                   max_backoff=config.get('outbox_max_backoff', 3600),
+                   dedup_window=config.get('outbox_dedup_window', 60),
+                   retention=config.get('outbox_retention', 86400))
+
+    def start(self):
+        """Drop old delivered rows, make rows left pending by a previous
+        run due now, and deliver due rows from the current IOLoop"""
+        now = time.time()
+        with self.db:
+            purged = self.db.execute(
+                "DELETE FROM outbox WHERE delivered < ?",
+                (now - self.retention,)).rowcount
+            self.db.execute("DELETE FROM outbox_alerts WHERE created < ?",
+                            (now - max(self.retention, self.dedup_window),))
+            pending = self.db.execute(
+                "UPDATE outbox SET next_attempt = ? WHERE delivered IS NULL",
+                (now,)).rowcount
+        _logger.info("Outbox %s: %s pending notifications, %s purged",
+                     self.filename, pending, purged)
+        self.pending.set(pending)
+        self.running = True
+        IOLoop.current().spawn_callback(self.run)
+
+    def register(self, name, dispatcher):
+        self.dispatchers[name] = dispatcher
+
+    def unregister(self, name, dispatcher=None):
+        """Stop queueing rows of name, unless dispatcher was replaced"""
+        if dispatcher is None or self.dispatchers.get(name) is dispatcher:
+            self.dispatchers.pop(name, None)
+
+    @coroutine
+    def add(self, name, messages, transitions=()):
+        """Store a batch leased for queueing, return its row id, the
+        messages kept and its key, or None if all were stored already. Transitions are
+        the (state, episode start) of the messages, None for an unknown
+        start; batches without transitions are never deduplicated"""
+        stored = yield self.executor.submit(self._insert, name, messages,
+                                            transitions)
+        if stored is not None:
+            self.pending.inc()
+        raise Return(stored)
+
+    def _insert(self, name, messages, transitions=()):
+        now = time.time()
+        with self.db:
+            if not transitions:
+                key = uuid.uuid4().hex
+            else:
+                messages, transitions = self._deduplicate(
+                    name, messages, transitions, now)
+                if not messages:
+                    return None
+                key = idempotency_key(name, transitions)
+            rowid = self.db.execute(
+                "INSERT INTO outbox (key, subscription, messages, created, "
+                "next_attempt) VALUES (?, ?, ?, ?, ?)",
+                (key, name, json.dumps(messages), now,
+                 now + self.lease)).lastrowid
+        return rowid, messages, key
+
+    def _deduplicate(self, name, messages, transitions, now):
+        """Drop the alerts of episodes already stored, record the others
+        with their episode, an unknown one starting now"""
+        kept, stamped = [], []
+        for message, (state, episode) in zip(messages, transitions):
+            row = self.db.execute(
+                "SELECT episode FROM outbox_alerts WHERE subscription = ? "
+                "AND state = ? AND created > ? ORDER BY created DESC LIMIT 1",
+                (name, state, now - self.dedup_window)).fetchone()
+            if row is not None and episode in (None, row[0]):
+                _logger.info("Notification of %s to %s already stored",
+                             state, name)
+                continue
+            if episode is None:
+                episode = now
+            kept.append(message)
+            stamped.append((state, episode))
+        self.db.executemany(
+            "INSERT INTO outbox_alerts VALUES (?, ?, ?, ?)",
+            [(name, state, episode, now) for state, episode in stamped])
+        return kept, stamped
+
+    def delivered(self, rowid):
+        """Mark a row delivered, return a future resolved once written"""
+        self.pending.dec()
+        return self.executor.submit(self._ack, [rowid])
+
+    def failed(self, rowid):
+        """Schedule the next attempt of a row, with exponential backoff"""
+        self.executor.submit(self._reschedule, rowid)
+
+    def release(self, rowid):
+        """Make a row that could not be queued due again"""
+        self.executor.submit(self._release, rowid)
+
+    def _reschedule(self, rowid):
+        with self.db:
+            attempts, = self.db.execute(
+                "SELECT attempts FROM outbox WHERE id = ?", (rowid,)).fetchone()
+            delay = min(self.max_backoff, self.backoff * 2 ** attempts)
+            delay += random.uniform(0, delay / 10.0)
+            self.db.execute(
+                "UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?",
+                (attempts + 1, time.time() + delay, rowid))
+        _logger.warning("Notification %s will be retried in %.0fs",
+                        rowid, delay)
+
+    def _release(self, rowid):
+        with self.db:
+            self.db.execute("UPDATE outbox SET next_attempt = ? WHERE id = ?",
+                            (time.time(), rowid))
+
+    def _ack(self, rowids):
+        with self.db:
+            self.db.executemany(
+                "UPDATE outbox SET delivered = ? WHERE id = ?",
+                [(time.time(), rowid) for rowid in rowids])
+
+    def _take(self, capacities):
+        """Lease up to capacity due rows of each subscription"""
+        now = time.time()
+        taken = {}
+        with self.db:
+            for name, capacity in capacities.items():
+                rows = self.db.execute(
+                    "SELECT id, messages, created, key FROM outbox "
+                    "WHERE delivered IS NULL AND next_attempt <= ? "
+                    "AND subscription = ? ORDER BY next_attempt LIMIT ?",
+                    (now, name, capacity)).fetchall()
+                self.db.executemany(
+                    "UPDATE outbox SET next_attempt = ? WHERE id = ?",
+                    [(now + self.lease, row[0]) for row in rows])
+                taken[name] = rows
+        return taken
+
+    @coroutine
+    def run(self):
+        while self.running:
+            busy = yield self.poll()
+            yield sleep(0.1 if busy else self.poll_interval)
+
+    @coroutine
+    def poll(self):
+        """Queue due rows again. Return True if queues were filled, so more
+        rows may be due"""
+        capacities = dict(
+            (name, dispatcher.queue.maxsize - dispatcher.queue.qsize())
+            for name, dispatcher in self.dispatchers.items()
+            if not dispatcher.queue.full())
+        try:
+            taken = {}
+            if capacities:
+                taken = yield self.executor.submit(self._take, capacities)
+        except Exception as ex:
+            _logger.error("Outbox poll failed: %s", ex)
+            raise Return(False)
+        busy = False
+        for name, rows in taken.items():
+            dispatcher = self.dispatchers.get(name)
+            for rowid, messages, created, key in rows:
+                if dispatcher is None:
+                    # unregistered meanwhile
+                    self.release(rowid)
+                elif dispatcher.put(json.loads(messages), rowid, created,
+                                    key):
+                    self.retries.inc()
+            busy = busy or len(rows) == capacities[name]
+        raise Return(busy)
+
+    def close(self):
+        """Close the database, rows still pending are delivered on next
+        start"""
+        self.running = False
+        self.executor.shutdown(wait=True)
+        self.db.close()
@@ -0,0 +1,169 @@
+"""Alerting policy between state transitions and notifiers: flap
+suppression, deduplication and rate limiting"""
+
+import time
+import logging
+from tornado.ioloop import IOLoop
+from metrics import REGISTRY
+
+_logger = logging.getLogger(__name__)
+
+
+class Hysteresis(object):
+    """Hold transitions until their state stayed True for a number of
+    consecutive polls, dropping those that flap back before.
+
+    A poll is an iteration of the endpoint that reported the transition,
+    unchanged and not modified responses included since they confirm the
+    state too. Only states waiting for confirmation are visited on each
+    poll."""
+
+    def __init__(self, polls=1):
+        self.polls = polls
+        self.pending = {}   # state -> [polls left, message, source]
+        self.suppressed = REGISTRY.counter(
+            'crawler_flaps_suppressed_total',
+            'Transitions dropped because the state flapped back')
+
+    def rise(self, state, message, source=None):
+        """State became True in a poll of source, return True if it is
+        confirmed already. The poll it rose in counts as the first one"""
+        if self.polls <= 1:
+            return True
+        self.pending[state] = [self.polls, message, source]
+        return False
+
+    def fall(self, state):
+        """State became False"""
+        if self.pending.pop(state, None) is not None:
+            self.suppressed.inc()
+            _logger.info("%s flapped, not notified", state)
+
+    def tick(self, source=None):
+        """Count a completed poll of source, return the (state, message)
+        confirmed by it. States risen outside a poll count every poll"""
+        confirmed = []
+        for state, pending in list(self.pending.items()):
+            if pending[2] is not None and pending[2] is not source:
+                continue
+            pending[0] -= 1
+            if pending[0] <= 0:
+                del self.pending[state]
+                confirmed.append((state, pending[1]))
+        return confirmed
+
+
+class TokenBucket(object):
+    """Allow rate events per hour on average, up to burst at once"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate / 3600.0   # tokens per second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def take(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait(self):
+        """Seconds until a token is available"""
+        return max(0, (1 - self.tokens) / self.rate)
+
+
+class Policy(object):
+    """Filter the alerts of one subscription before its dispatcher.
+
+    An alert for a state already sent within dedup_window seconds is
+    dropped. With a rate limit, alerts exceeding it are held and sent
+    together as one digest as soon as the bucket allows, so none is lost.
+    Every alert costs O(1)."""
+
+    def __init__(self, dispatcher, rate_limit=None, burst=1, dedup_window=0,
+                 name='default'):
+        self.dispatcher = dispatcher
+        self.bucket = TokenBucket(rate_limit, burst) if rate_limit else None
+        self.dedup_window = dedup_window
+        self.last_sent = {}     # state -> time of its last alert
+        self.held = []          # messages waiting for a token
+        self.held_transitions = []  # their (state, episode start)
+        self.held_timeout = None
+        self.deduplicated = REGISTRY.counter(
+            'notification_deduplicated_total',
+            'Alerts dropped as already sent', subscription=name)
+        self.rate_limited = REGISTRY.counter(
+            'notification_rate_limited_total',
+            'Alerts delayed into a digest by the rate limit',
+            subscription=name)
+
+    @classmethod
+    def from_config(cls, dispatcher, config, name='default'):
+        return cls(dispatcher,
+                   rate_limit=config.get('notification_rate_limit'),
+                   burst=config.get('notification_burst', 1),
+                   dedup_window=config.get('dedup_window', 0),
+                   name=name)
+
+    def submit(self, changes, episodes=None):
+        """Submit (state, message) alerts, return the number let through
+        or held. Each is stamped with the start of the availability of its
+        state from episodes, now by default"""
+        now = time.time()
+        messages = []
+        transitions = []
+        for state, message in changes:
+            if self.dedup_window:
+                last = self.last_sent.get(state)
+                if last is not None and now - last < self.dedup_window:
+                    self.deduplicated.inc()
+                    continue
+                self.last_sent[state] = now
+            messages.append(message)
+            transitions.append(
+                (state, episodes.get(state, now) if episodes is not None
+                 else now))
+        if not messages:
+            return 0
+        if self.bucket is None:
+            self.dispatcher.submit(messages, transitions)
+            return len(messages)
+        self.held.extend(messages)
+        self.held_transitions.extend(transitions)
+        if self.held_timeout is None:
+            self.release()
+        if self.held:
+            self.rate_limited.inc(len(messages))
+        return len(messages)
+
+    def release(self):
+        """Send held alerts as one notification if a token is available,
+        otherwise try again when one will be"""
+        self.held_timeout = None
+        if not self.held:
+            return
+        if self.bucket.take():
+            self.submit_held()
+            return
+        _logger.info("Rate limit reached, %s alert(s) held for %.0fs",
+                     len(self.held), self.bucket.wait())
+        self.held_timeout = IOLoop.current().call_later(
+            self.bucket.wait(), self.release)
+
+    def flush(self):
+        """Submit held alerts regardless of the rate limit"""
+        if self.held_timeout is not None:
+            IOLoop.current().remove_timeout(self.held_timeout)
+            self.held_timeout = None
+        if self.held:
+            self.submit_held()
+
+    def submit_held(self):
+        messages, self.held = self.held, []
+        transitions, self.held_transitions = self.held_transitions, []
+        self.dispatcher.submit(messages, transitions)
@@ -0,0 +1,97 @@
+"""Reload config.json and mappings when they change on disk, without
+restarting the IOLoop nor losing states"""
+
+import os
+import json
+import logging
+from tornado.gen import coroutine
+from tornado.ioloop import PeriodicCallback
+
+_logger = logging.getLogger(__name__)
+
+# options read by the endpoints and their schedulers
+ENDPOINT_OPTIONS = ('crawler_interval', 'request_timeout', 'endpoints',
+                    'streaming_parse', 'fast_interval', 'fast_window',
+                    'max_backoff', 'hot_hour_threshold', 'mirrors',
+                    'hedge_percentile', 'hedge_min_delay',
+                    'hedge_initial_delay')
+# options of components set up once at startup
+RESTART_PREFIXES = ('http_', 'history_', 'cluster_', 'outbox_', 'webhook_',
+                    'events_', 'autobuy', 'confirm_polls', 'event_loop',
+                    'catalog_')
+
+
+class ConfigReloader(object):
+    """Poll modification times of config.json and mappings.
+
+    Changed mappings rebuild the crawler index only. A changed config
+    rebuilds endpoints if their options changed, and restarts the
+    subscriptions whose settings changed, others keep their notifier
+    sessions. A file that fails to parse is ignored until fixed."""
+
+    def __init__(self, filename, mapping_files, config, crawler,
+                 subscriptions, cluster=None, interval=5):
+        self.filename = filename
+        self.mapping_files = tuple(mapping_files)
+        self.config = config
+        self.crawler = crawler
+        self.subscriptions = subscriptions
+        self.cluster = cluster
+        self.interval = interval
+        self.mtimes = self.current_mtimes()
+        self.periodic_cb = None
+
+    def current_mtimes(self):
+        mtimes = {}
+        for filename in (self.filename,) + self.mapping_files:
+            try:
+                mtimes[filename] = os.path.getmtime(filename)
+            except OSError:
+                mtimes[filename] = None
+        return mtimes
+
+    def start(self):
+        self.periodic_cb = PeriodicCallback(self.check,
+                                            self.interval * 1000)
+        self.periodic_cb.start()
+
+    @coroutine
+    def check(self):
+        mtimes = self.current_mtimes()
+        changed = set(f for f in mtimes if mtimes[f] != self.mtimes[f])
+        self.mtimes = mtimes
+        if changed.intersection(self.mapping_files):
+            self.crawler.reload_mappings()
+        if self.filename in changed:
+            yield self.reload_config()
+
+    @coroutine
+    def reload_config(self):
+        try:
+            with open(self.filename) as config_file:
+                config = json.load(config_file)
+        except (OSError, IOError, ValueError) as ex:
+            _logger.error("Cannot reload %s, keeping current config: %s",
+                          self.filename, ex)
+            return
+        if 'notifier' not in config and 'servers' in config:
+            config['notifier'] = 'email'
+        old, self.config = self.config, config
+        _logger.info("Reloading %s", self.filename)
+        if any(old.get(key) != config.get(key) for key in ENDPOINT_OPTIONS):
+            self.crawler.reload_endpoints(config)
+            _logger.info("Polling %s", [e.name for e in self.crawler.endpoints])
+            if self.cluster is not None:
+                # share the new endpoints on next heartbeat
+                self.cluster.nodes = None
+        restart = sorted(key for key in set(old) | set(config)
+                         if key.startswith(RESTART_PREFIXES) and
+                         old.get(key) != config.get(key))
+        if restart:
+            _logger.warning("Restart the crawler to apply %s",
+                            ', '.join(restart))
+        yield self.subscriptions.set_config(config)
+
+    def stop(self):
+        if self.periodic_cb is not None:
+            self.periodic_cb.stop()
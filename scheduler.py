@@ -0,0 +1,80 @@
+"""Adaptive polling schedule: faster around restocks, slower on errors"""
+
+import time
+import random
+import logging
+from metrics import REGISTRY
+
+_logger = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """Compute the delay before the next poll of an endpoint.
+
+    The base interval is used by default. It is shortened to fast_interval
+    for fast_window seconds after a state flip, and during hours of the day
+    in which at least hot_hour_threshold restocks were seen. Consecutive
+    errors back off exponentially, with full jitter, up to max_backoff."""
+
+    def __init__(self, interval, fast_interval=None, fast_window=300,
+                 max_backoff=300, hot_hour_threshold=3, name=''):
+        self.interval = interval
+        self.fast_interval = fast_interval or interval
+        self.fast_window = fast_window
+        self.max_backoff = max_backoff
+        self.hot_hour_threshold = hot_hour_threshold
+        self.errors = 0         # consecutive failed iterations
+        self.last_flip = 0      # timestamp of the last state flip
+        self.restock_hours = [0] * 24
+        self.reason = None
+        self.gauge = REGISTRY.gauge(
+            'crawler_poll_interval_seconds',
+            'Delay before the next poll', endpoint=name)
+        self.name = name
+
+    @classmethod
+    def from_config(cls, interval, config, name=''):
+        """Build a scheduler for an endpoint polled every interval seconds"""
+        return cls(interval,
+                   fast_interval=config.get('fast_interval'),
+                   fast_window=config.get('fast_window', 300),
+                   max_backoff=config.get('max_backoff', 300),
+                   hot_hour_threshold=config.get('hot_hour_threshold', 3),
+                   name=name)
+
+    def record_error(self):
+        self.errors += 1
+
+    def record_success(self, flips=0, restocks=0):
+        self.errors = 0
+        now = time.time()
+        if flips:
+            self.last_flip = now
+        if restocks:
+            self.restock_hours[time.localtime(now).tm_hour] += restocks
+
+    def next_delay(self):
+        """Return seconds to wait before the next poll"""
+        now = time.time()
+        if self.errors:
+            ceiling = min(self.max_backoff, self.interval * 2 ** self.errors)
+            delay = random.uniform(self.interval, max(self.interval, ceiling))
+            reason = 'backoff'
+        elif now - self.last_flip < self.fast_window:
+            delay, reason = self.fast_interval, 'recent_flip'
+        elif self.restock_hours[time.localtime(now).tm_hour] >= \
+                self.hot_hour_threshold:
+            delay, reason = self.fast_interval, 'hot_hour'
+        else:
+            delay, reason = self.interval, 'base'
+        if self.fast_interval == self.interval and reason != 'backoff':
+            reason = 'base'
+        if reason != self.reason:
+            _logger.info("Polling %s every %.1fs (%s)", self.name, delay, reason)
+            REGISTRY.counter(
+                'crawler_interval_changes_total',
+                'Changes of polling interval, by reason',
+                endpoint=self.name, reason=reason).inc()
+            self.reason = reason
+        self.gauge.set(delay)
+        return delay
@@ -0,0 +1,263 @@
+"""Lookup tables compiled once from the mappings and the tracked states"""
+
+from catalog import guess_range, offer_url
+# Python 3 imports
+try:
+    from sys import intern
+except ImportError:
+    pass
+
+UNAVAILABLE = frozenset(['unavailable', 'unknown'])
+
+# availability tiers, from worst to best; 'available' stands for any
+# availability the API may return that is not listed here
+TIERS = ('unavailable', 'available', '480H', '240H', '120H', '72H', '24H',
+         '1H-low', '1H-high')
+AVAILABLE = 1
+TIER_IDS = dict((name, i) for i, name in enumerate(TIERS))
+TIER_IDS['unknown'] = 0
+
+
+def tier_name(name):
+    """Canonical spelling of a tier name given in config"""
+    for tier in TIERS:
+        if tier.lower() == name.lower():
+            return tier
+    raise ValueError("Unknown availability tier %r, use one of %s"
+                     % (name, ', '.join(TIERS[AVAILABLE:])))
+
+
+def state_key(server_type, region, tier='available'):
+    """Name of the state telling if server_type is available in region,
+    with at least the given tier"""
+    return intern('%s_%s_in_%s' % (server_type.lower(), tier.lower(),
+                                   region.lower()))
+
+
+def build_message(hardware, server_type, region, tier='available',
+                  offer=None):
+    """Notification message sent when a state becomes True, with the
+    specs, price and product page of the offer if known"""
+    offer = offer or {'range': guess_range(hardware)}
+    message = {
+        'title': "{0} is available".format(server_type),
+        'text': "Server {server} is available in {region}".format(
+            server=server_type, region=region.capitalize()),
+        'url': offer.get('url') or offer_url(offer)
+    }
+    if tier != 'available':
+        message['text'] += " ({0})".format(tier)
+    details = [detail for detail in (
+        offer.get('specs'), offer.get('price') and
+        "{0}/month".format(offer['price'])) if detail]
+    if details:
+        message['text'] += ": {0}".format(', '.join(details))
+    return message
+
+
+class View(object):
+    """States of one server type in one place, derived from the number of
+    its cells in each tier"""
+
+    __slots__ = ('hardware', 'server_type', 'place', 'counts', 'states',
+                 'offer')
+
+    def __init__(self, hardware, server_type, place, states, offer=None):
+        self.hardware = hardware    # code used to build messages
+        self.offer = offer          # catalog offer of the hardware
+        self.server_type = server_type
+        self.place = place
+        self.counts = [0] * len(TIERS)
+        self.states = states        # tuple of (tier id, state)
+
+    def best(self):
+        for tier in range(len(TIERS) - 1, 0, -1):
+            if self.counts[tier]:
+                return tier
+        return 0
+
+    def values(self, best, before=None):
+        """(state, value, message) of the states, only those that differ
+        from the best tier before if given"""
+        return [(state, best >= tier,
+                 build_message(self.hardware, self.server_type, self.place,
+                               TIERS[tier], self.offer)
+                 if best >= tier else None)
+                for tier, state in self.states
+                if before is None or (best >= tier) != (before >= tier)]
+
+
+class StateIndex(object):
+    """Map API cells, i.e. (hardware code, datacenter), straight to the
+    views deriving tracked states from them.
+
+    Built once per set of tracked states, so that an API entry for
+    untracked hardware is dropped with a single set lookup. With
+    tracked_states=None, availability in every region is tracked.
+
+    Besides regions, every datacenter is a place of its own, so that
+    e.g. 'ks-3a_available_in_rbx' or 'ks-3a_1h-high_in_rbx' can be
+    tracked too. Messages carry the details of offers, by hardware code,
+    if given."""
+
+    def __init__(self, server_types, regions, tracked_states=None,
+                 offers=None):
+        # (hardware code, datacenter) -> tuple of views it counts in
+        self.cells = {}
+        self.offers = offers or {}
+        self.views = []
+        places_by_name = dict(regions)
+        for places in regions.values():
+            for datacenter in places:
+                places_by_name.setdefault(datacenter, [datacenter])
+        views = {}
+        for hardware, server_type in server_types.items():
+            for place, datacenters in places_by_name.items():
+                key = (server_type, place)
+                if key not in views:
+                    views[key] = self._view(hardware, server_type, place,
+                                            tracked_states)
+                view = views[key]
+                if view is None:
+                    continue
+                for datacenter in datacenters:
+                    cell = (hardware, datacenter)
+                    self.cells[cell] = self.cells.get(cell, ()) + (view,)
+        self.hardware = frozenset(hardware for hardware, _ in self.cells)
+
+    def _view(self, hardware, server_type, place, tracked_states):
+        """View of server_type in place, None if none of its states is
+        tracked"""
+        states = []
+        for tier in range(AVAILABLE, len(TIERS)):
+            state = state_key(server_type, place, TIERS[tier])
+            if tracked_states is None and tier == AVAILABLE or \
+                    tracked_states is not None and state in tracked_states:
+                states.append((tier, state))
+        if not states:
+            return None
+        view = View(hardware, server_type, place, tuple(states),
+                    self.offers.get(hardware))
+        self.views.append(view)
+        return view
+
+    def states(self):
+        return [state for view in self.views for _, state in view.states]
+
+    def load(self, tiers):
+        """Count a whole table of cell tiers, return (state, value,
+        message) for every tracked state"""
+        for view in self.views:
+            view.counts = [0] * len(TIERS)
+        for cell, tier in tiers.items():
+            for view in self.cells.get(cell, ()):
+                view.counts[tier] += 1
+        return [value for view in self.views
+                for value in view.values(view.best())]
+
+    def move(self, cell, old, new):
+        """Move a cell from tier old to new, return (state, value, message)
+        for the states it changed. Old is None for a cell not seen before,
+        all its states are returned then"""
+        changes = []
+        for view in self.cells.get(cell, ()):
+            before = view.best()
+            view.counts[old or 0] -= 1
+            view.counts[new] += 1
+            after = view.best()
+            if old is None:
+                changes.extend(view.values(after))
+            elif after != before:
+                changes.extend(view.values(after, before))
+        return changes
+
+
+class StateTable(object):
+    """Availability tier of every (hardware, datacenter) cell seen.
+
+    Region and subscription level states are derived views, only updated
+    for cells that changed, so that the work per poll grows with the
+    number of changes rather than entries times places.
+
+    Each source, i.e. endpoint, reporting a cell keeps its own tier; the
+    cell takes the best of them, so a server is available if any endpoint
+    says so, and a source that skipped a poll keeps its last report."""
+
+    def __init__(self, index):
+        self.tiers = {}     # (hardware, datacenter) -> best tier id
+        self.sources = {}   # (hardware, datacenter) -> {source: tier id}
+        self.index = index
+
+    def reindex(self, index):
+        """Switch to an index of other tracked states, return all their
+        values"""
+        self.index = index
+        return index.load(self.tiers)
+
+    def load(self, availabilities):
+        """Replace the table from a dict of cell availabilities, return the
+        values of all tracked states"""
+        self.tiers = dict((cell, TIER_IDS.get(availability, AVAILABLE))
+                          for cell, availability in availabilities.items())
+        self.sources = {}
+        return self.index.load(self.tiers)
+
+    def retain(self, hardware):
+        """Forget the cells of hardware codes missing from hardware, return
+        the values of all tracked states"""
+        self.tiers = dict((cell, tier) for cell, tier in self.tiers.items()
+                          if cell[0] in hardware)
+        self.sources = dict((cell, reported)
+                            for cell, reported in self.sources.items()
+                            if cell[0] in hardware)
+        return self.index.load(self.tiers)
+
+    def forget(self, sources, record=None):
+        """Drop the reports of sources no longer polled, return (state,
+        value, message) for the derived states that changed. Cells only
+        they reported keep their last tier"""
+        changes = []
+        for cell, reported in self.sources.items():
+            if not any(source in reported for source in sources):
+                continue
+            for source in sources:
+                reported.pop(source, None)
+            if reported:
+                changes.extend(self._set(cell, max(reported.values()),
+                                         None, record))
+        return changes
+
+    def update(self, entry, record=None, source=None):
+        """Update the cells of one API entry reported by source, return
+        (state, value, message) for the derived states that changed.
+        record(hardware, datacenter, availability, previous) is called for
+        every changed cell"""
+        hardware = entry['hardware']
+        if hardware not in self.index.hardware:
+            return ()
+        changes = []
+        sources = self.sources
+        for dc in entry['datacenters']:
+            cell = (hardware, dc['datacenter'])
+            new = TIER_IDS.get(dc['availability'], AVAILABLE)
+            reported = sources.get(cell)
+            if reported is None:
+                reported = sources[cell] = {}
+            elif reported.get(source) == new:
+                continue
+            reported[source] = new
+            best = max(reported.values()) if len(reported) > 1 else new
+            changes.extend(self._set(cell, best, dc['availability']
+                                     if best == new else None, record))
+        return changes
+
+    def _set(self, cell, new, availability, record):
+        """Move a cell to tier new, return the derived changes"""
+        old = self.tiers.get(cell)
+        if new == old:
+            return ()
+        self.tiers[cell] = new
+        if record is not None:
+            record(cell[0], cell[1], availability or TIERS[new],
+                   None if old is None else TIERS[old])
+        return self.index.move(cell, old, new)
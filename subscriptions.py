@@ -0,0 +1,247 @@
+"""Subscriptions: many users, each with own servers, places and notifier"""
+
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop, PeriodicCallback
+from dispatcher import Dispatcher
+from policy import Policy
+from notifiers import load_notifier
+from state_index import state_key, tier_name
+
+_logger = logging.getLogger(__name__)
+
+# crawler options, not inherited by subscriptions, so that changing them
+# in config.json does not restart notifiers
+CRAWLER_OPTIONS = frozenset([
+    'crawler_interval', 'request_timeout', 'endpoints', 'streaming_parse',
+    'fast_interval', 'fast_window', 'max_backoff', 'hot_hour_threshold',
+    'config_reload_interval', 'confirm_polls', 'mirrors', 'event_loop',
+    'shutdown_timeout'])
+CRAWLER_PREFIXES = ('http_', 'history_', 'cluster_', 'subscriptions_',
+                    'outbox_', 'webhook_', 'events_', 'autobuy', 'hedge_',
+                    'catalog_')
+
+
+def subscription_states(config):
+    """States watched by a subscription: every server in every region or
+    datacenter it lists, available with at least its tier"""
+    places = list(config.get('regions', []))
+    if 'region' in config:
+        places.append(config['region'])
+    places.extend(config.get('datacenters', []))
+    tier = tier_name(config.get('tier', 'available'))
+    return frozenset(state_key(server, place, tier)
+                     for server in config['servers'] for place in places)
+
+
+class Subscription(object):
+    """One user, or team, and the channel alerts are delivered to"""
+
+    def __init__(self, name, config, notifier, outbox=None):
+        self.name = name
+        self.config = config
+        self.states = subscription_states(config)
+        self.notifier = notifier
+        self.dispatcher = Dispatcher.from_config(notifier, config,
+                                                 outbox=outbox, name=name)
+        self.policy = Policy.from_config(self.dispatcher, config, name=name)
+
+
+class SubscriptionManager(object):
+    """Fan state transitions out to the subscriptions watching them.
+
+    An inverted index from state to subscribers keeps the fan-out
+    proportional to the subscribers of each changed state. Subscriptions
+    defined in a JSON file are reloaded when the file changes: new and
+    modified ones are started, removed ones are drained and closed."""
+
+    def __init__(self, config, tracked_states_callback=None):
+        self.config = config    # global config, inherited by subscriptions
+        self.tracked_states_callback = tracked_states_callback
+        self.subscriptions = {}
+        self.by_state = {}
+        self.config_definitions = []    # loaded from config.json
+        self.file_definitions = []      # loaded from subscriptions file
+        self.filename = None
+        self.mtime = None
+        self.periodic_cb = None
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        # optional durable outbox shared by all subscriptions
+        self.outbox = None
+        if config.get('outbox_file'):
+            from outbox import Outbox
+            self.outbox = Outbox.from_config(config)
+            self.outbox.start()
+
+    def subscription_config(self, definition):
+        config = dict((key, value) for key, value in self.config.items()
+                      if key not in CRAWLER_OPTIONS and
+                      not key.startswith(CRAWLER_PREFIXES))
+        config.update(definition)
+        return config
+
+    def add(self, name, config, notifier):
+        subscription = Subscription(name, config, notifier, self.outbox)
+        subscription.dispatcher.start()
+        if config.get('fast_start'):
+            # hold notifications until the deferred system check is done
+            subscription.dispatcher.ready.clear()
+            IOLoop.current().spawn_callback(self.validate, subscription)
+        self.subscriptions[name] = subscription
+        _logger.info("Subscription %s tracks %s", name,
+                     sorted(subscription.states))
+        return subscription
+
+    def load(self, definitions, from_file=False):
+        """Start subscriptions at startup, raise if a notifier fails"""
+        if from_file:
+            self.file_definitions = list(definitions)
+        else:
+            self.config_definitions.extend(definitions)
+        for definition in definitions:
+            config = self.subscription_config(definition)
+            self.add(definition.get('name', 'default'), config,
+                     load_notifier(config))
+        self.rebuild_index()
+
+    @coroutine
+    def validate(self, subscription):
+        """Run the notifier system check in the background"""
+        try:
+            yield self.executor.submit(subscription.notifier.validate)
+        except Exception:
+            _logger.exception("Notifier check of subscription %s failed, "
+                              "notifications may not be delivered",
+                              subscription.name)
+        subscription.dispatcher.ready.set()
+
+    def rebuild_index(self):
+        by_state = {}
+        for subscription in self.subscriptions.values():
+            for state in subscription.states:
+                by_state.setdefault(state, []).append(subscription)
+        self.by_state = dict((state, tuple(subs))
+                             for state, subs in by_state.items())
+        if self.tracked_states_callback is not None:
+            self.tracked_states_callback(self.tracked_states())
+
+    def tracked_states(self):
+        return frozenset(self.by_state)
+
+    def notify(self, changes, episodes=None):
+        """Submit one batch per subscription for a crawler change-set,
+        episodes telling when the availability of each state started"""
+        batches = {}
+        for state, message in changes:
+            for subscription in self.by_state.get(state, ()):
+                batches.setdefault(subscription, []).append(
+                    (state, message or {}))
+        for subscription, alerts in list(batches.items()):
+            count = subscription.policy.submit(alerts, episodes)
+            if count:
+                _logger.info("Will notify %s of %s message(s)",
+                             subscription.name, count)
+            else:
+                del batches[subscription]
+        return batches
+
+    def watch(self, filename, interval=5):
+        """Load subscriptions from filename, and reload them on change"""
+        self.filename = filename
+        self.mtime = os.path.getmtime(filename)
+        with open(filename) as subscriptions_file:
+            self.load(json.load(subscriptions_file), from_file=True)
+        self.periodic_cb = PeriodicCallback(self.check_file, interval * 1000)
+        self.periodic_cb.start()
+
+    @coroutine
+    def check_file(self):
+        try:
+            mtime = os.path.getmtime(self.filename)
+            if mtime == self.mtime:
+                return
+            self.mtime = mtime
+            with open(self.filename) as subscriptions_file:
+                definitions = json.load(subscriptions_file)
+        except (OSError, IOError, ValueError) as ex:
+            _logger.error("Cannot reload subscriptions from %s: %s",
+                          self.filename, ex)
+            return
+        self.file_definitions = definitions
+        yield self.reload(self.config_definitions + self.file_definitions)
+
+    @coroutine
+    def set_config(self, config):
+        """Apply a new global config, restarting only the subscriptions
+        whose settings changed"""
+        self.config = config
+        self.config_definitions = \
+            [dict(name='default')] if 'servers' in config else []
+        yield self.reload(self.config_definitions + self.file_definitions)
+
+    @coroutine
+    def reload(self, definitions):
+        """Swap in new subscription definitions without stopping the loop.
+        Current subscriptions keep notifying until their replacements are
+        loaded and indexed, then they are stopped"""
+        wanted = dict((d.get('name', 'default'), self.subscription_config(d))
+                      for d in definitions)
+        loaded = {}
+        for name, config in wanted.items():
+            current = self.subscriptions.get(name)
+            if current is not None and current.config == config:
+                continue
+            try:
+                # notifier checks may log in over the network
+                notifier = yield self.executor.submit(load_notifier, config)
+            except Exception:
+                _logger.exception("Subscription %s failed to load%s", name,
+                                  ", keeping its previous settings"
+                                  if current is not None else "")
+                continue
+            loaded[name] = (config, notifier)
+        retired = [subscription for name, subscription
+                   in self.subscriptions.items()
+                   if name not in wanted or name in loaded]
+        for name, (config, notifier) in loaded.items():
+            self.add(name, config, notifier)
+        for subscription in retired:
+            if self.subscriptions.get(subscription.name) is subscription:
+                del self.subscriptions[subscription.name]
+        self.rebuild_index()
+        for subscription in retired:
+            yield self.stop(subscription)
+        _logger.info("Reloaded %s subscriptions", len(self.subscriptions))
+
+    @coroutine
+    def stop(self, subscription):
+        _logger.info("Stopping subscription %s", subscription.name)
+        subscription.policy.flush()
+        yield subscription.dispatcher.stop()
+        subscription.notifier.close()
+
+    @coroutine
+    def shutdown(self, timeout=10):
+        """Deliver the notifications held or queued by every subscription
+        within timeout seconds, then stop their workers"""
+        for subscription in self.subscriptions.values():
+            subscription.policy.flush()
+        try:
+            yield [subscription.dispatcher.stop(timeout)
+                   for subscription in self.subscriptions.values()]
+        except gen.TimeoutError:
+            _logger.warning("Notifications still queued after %ss are %s",
+                            timeout, "kept in the outbox" if self.outbox
+                            else "lost")
+
+    def close(self):
+        if self.periodic_cb is not None:
+            self.periodic_cb.stop()
+        for subscription in self.subscriptions.values():
+            subscription.notifier.close()
+        if self.outbox is not None:
+            self.outbox.close()
@@ -0,0 +1,155 @@
+"""Optional HTTP server exposing metrics, states, events and profiles of the
+crawler"""
+
+import io
+import json
+import time
+import pstats
+import logging
+import datetime
+import cProfile
+import tornado.web
+from tornado.gen import coroutine
+from tornado.iostream import StreamClosedError
+from metrics import REGISTRY
+from state_index import TIERS
+
+_logger = logging.getLogger(__name__)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Metrics in the Prometheus text format"""
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(REGISTRY.render())
+
+
+class StatesHandler(tornado.web.RequestHandler):
+    """Current value of every state tracked by the crawler, and tier of
+    every cell, as JSON"""
+
+    def initialize(self, crawler):
+        self.crawler = crawler
+
+    def get(self):
+        self.write({'states': self.crawler.STATES,
+                    'cells': cell_tiers(self.crawler),
+                    'unknown_hardware': self.crawler.unknown_hardware})
+
+
+class EventsHandler(tornado.web.RequestHandler):
+    """Server-Sent Events stream of availability changes of the cells.
+
+    A snapshot of every cell tier is sent first; clients reconnecting with
+    a Last-Event-ID header get the events they missed instead."""
+
+    def initialize(self, crawler):
+        self.crawler = crawler
+        self.closed = False
+
+    def on_connection_close(self):
+        self.closed = True
+
+    def write_event(self, name, data, event_id=None):
+        if event_id is not None:
+            self.write('id: %s\n' % event_id)
+        self.write('event: %s\ndata: %s\n\n' % (name, json.dumps(data)))
+
+    @coroutine
+    def get(self):
+        hub = self.crawler.events
+        if hub is None:
+            raise tornado.web.HTTPError(404, "Event stream is disabled")
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        last_id = self.request.headers.get('Last-Event-ID', '')
+        if last_id.isdigit() and int(last_id) <= hub.seq:
+            seq = int(last_id)
+        else:
+            seq = hub.seq
+            self.write_event('snapshot', cell_tiers(self.crawler), seq)
+        hub.subscribers.inc()
+        try:
+            while not self.closed:
+                yield self.flush()
+                events = yield hub.wait(seq, timeout=15)
+                if not events:
+                    self.write(': keepalive\n\n')
+                for event in events:
+                    self.write_event('change', event, event['id'])
+                    seq = event['id']
+        except StreamClosedError:
+            pass
+        finally:
+            hub.subscribers.dec()
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+    """cProfile of the whole IOLoop thread during the next N iterations,
+    e.g. /profile?iterations=5&sort=tottime"""
+
+    running = False
+
+    def initialize(self, crawler):
+        self.crawler = crawler
+
+    @coroutine
+    def get(self):
+        iterations = int(self.get_argument('iterations', 5))
+        sort = self.get_argument('sort', 'cumulative')
+        if ProfileHandler.running:
+            raise tornado.web.HTTPError(409, "A profile is already running")
+        ProfileHandler.running = True
+        profile = cProfile.Profile()
+        started = time.time()
+        profile.enable()
+        try:
+            for _ in range(iterations):
+                yield self.crawler.iteration_done.wait(
+                    timeout=datetime.timedelta(minutes=10))
+        finally:
+            profile.disable()
+            ProfileHandler.running = False
+        output = io.StringIO()
+        output.write(u"%d iterations in %.3fs\n\n" % (
+            iterations, time.time() - started))
+        pstats.Stats(profile, stream=output).sort_stats(sort).print_stats(50)
+        self.set_header('Content-Type', 'text/plain')
+        self.write(output.getvalue())
+
+
+class AckHandler(tornado.web.RequestHandler):
+    """Acknowledge an alert of the multi notifier, cancelling its
+    escalation"""
+
+    def get(self, alert_id):
+        from notifiers.multi_notifier import MultiNotifier
+        if not MultiNotifier.acknowledge(alert_id):
+            raise tornado.web.HTTPError(404, "Unknown or escalated alert")
+        self.write("Alert %s acknowledged\n" % alert_id)
+    post = get
+
+
+def cell_tiers(crawler):
+    """Tier of every cell, keyed by 'hardware/datacenter'"""
+    return dict(('%s/%s' % cell, TIERS[tier])
+                for cell, tier in crawler.table.tiers.items())
+
+
+def make_app(crawler):
+    return tornado.web.Application([
+        (r'/metrics', MetricsHandler),
+        (r'/states', StatesHandler, {'crawler': crawler}),
+        (r'/events', EventsHandler, {'crawler': crawler}),
+        (r'/profile', ProfileHandler, {'crawler': crawler}),
+        (r'/ack/(\w+)', AckHandler),
+    ])
+
+
+def start_server(crawler, port, address='127.0.0.1'):
+    """Serve the crawler app on the current IOLoop"""
+    app = make_app(crawler)
+    server = app.listen(port, address)
+    _logger.info("Serving metrics on http://%s:%s/metrics", address, port)
+    return server